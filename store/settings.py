@@ -116,6 +116,66 @@ DATABASES = {
     }
 }
 
+# The catalog version, cached catalog pages and facets must be shared by every web worker, run_workers and
+# management command, or a change made in one process is invisible to the others until the entries time out.
+# Any deployment running more than one process sets STORE_REDIS_URL (needs the redis package) or
+# STORE_MEMCACHED_LOCATION (needs pymemcache). Without either, the per-process LocMemCache is used, which only
+# suits the tests and a single runserver; the store_app.W001 check warns about it when DEBUG is off.
+if os.environ.get('STORE_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['STORE_REDIS_URL'],
+        }
+    }
+elif os.environ.get('STORE_MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': os.environ['STORE_MEMCACHED_LOCATION'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+# Seconds a cached catalog response (/product/, /product/<pk>/, /category/) is kept for one catalog version
+CATALOG_CACHE_TIMEOUT = 300
+# Price bands counted by /product/facets/, as (min, max) with max exclusive and None for open-ended
+PRODUCT_PRICE_BANDS = ((0, 10), (10, 50), (50, 100), (100, None))
+FACETS_CACHE_TIMEOUT = 3600
+
+# Resized copies generated for every product image, exposed as ProductSerializer.image_variants
+PRODUCT_IMAGE_VARIANTS = {
+    'thumbnail': {'size': (200, 200), 'format': 'JPEG'},
+    'thumbnail_webp': {'size': (200, 200), 'format': 'WEBP'},
+    'medium_webp': {'size': (800, 800), 'format': 'WEBP'},
+}
+PRODUCT_IMAGE_QUALITY = 85
+# Processes resizing uploads off the request thread; 0 resizes inline
+PRODUCT_IMAGE_WORKERS = 2
+
+# How long an open cart holds the stock it reserved; release_expired_reservations reclaims older holds
+STOCK_RESERVATION_TTL = timedelta(minutes=30)
+
+# How long a response stored under an Idempotency-Key header is replayed to retries
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+
+# manage.py run_workers: workers started by default, seconds an idle worker waits before polling again,
+# and how long a job may stay running before a new run_workers requeues it as abandoned
+JOB_WORKERS = 4
+JOB_POLL_INTERVAL = 1
+JOB_TIMEOUT = timedelta(minutes=10)
+# how long finished jobs and their results are kept before purge_jobs deletes them
+JOB_RETENTION = timedelta(days=7)
+
+# manage.py apply_retention: received/delivered orders older than this are archived,
+# open carts untouched for this long are purged
+ORDER_RETENTION_DAYS = 365
+ABANDONED_CART_DAYS = 30
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Category, Product, Cart, CartItem, PaymentDetails, ShippingAddress, Order, Feedback
+from .models import Category, Product, Cart, CartItem, PaymentDetails, ShippingAddress, Order, Feedback, \
+    StockReservation
 
 admin.site.register(Category)
 admin.site.register(Product)
@@ -22,3 +23,4 @@ admin.site.register(PaymentDetails)
 admin.site.register(ShippingAddress)
 admin.site.register(Order)
 admin.site.register(Feedback)
+admin.site.register(StockReservation)
@@ -0,0 +1,70 @@
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+from .filters import canonical_id_list
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # Seeded from the clock so an evicted counter never restarts at a version that is still cached
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        get_catalog_version()
+
+
+def canonical_query_string(query_params, id_list_params=()):
+    items = [(key, canonical_id_list(value) if key in id_list_params else value)
+             for key in query_params for value in query_params.getlist(key)]
+    return urlencode(sorted(items))
+
+
+class CatalogCacheMixin:
+    # Caches GET list/detail responses under the current catalog version. The version is bumped whenever
+    # a product, category or feedback changes, so entries are never invalidated one by one.
+    cache_timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+    def get_cache_key(self, request, version):
+        filterset_class = getattr(self, 'filterset_class', None)
+        query = canonical_query_string(request.query_params, getattr(filterset_class, 'id_list_params', ()))
+        url = '%s:%s%s?%s' % (version, request.get_host(), request.path, query)
+        return 'catalog:%s' % hashlib.md5(url.encode()).hexdigest()
+
+    def cached_response(self, request, build_response):
+        key = self.get_cache_key(request, get_catalog_version())
+        etag = '"%s"' % key.split(':', 1)[1]
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        data = cache.get(key)
+        if data is None:
+            response = build_response()
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            cache.set(key, response.data, self.cache_timeout)
+        else:
+            response = Response(data)
+        response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, lambda: super(CatalogCacheMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request,
+                                    lambda: super(CatalogCacheMixin, self).retrieve(request, *args, **kwargs))
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+PER_PROCESS_CACHES = ('django.core.cache.backends.locmem.LocMemCache',
+                      'django.core.cache.backends.dummy.DummyCache')
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    # the catalog version is bumped in whichever process made the change, so every process must see one cache
+    if settings.DEBUG or settings.CACHES['default']['BACKEND'] not in PER_PROCESS_CACHES:
+        return []
+    return [Warning("The default cache is local to each process, so catalog and facet invalidations made by one "
+                    "worker or command are not seen by the others",
+                    hint="Set STORE_REDIS_URL or STORE_MEMCACHED_LOCATION", id='store_app.W001')]
@@ -0,0 +1,128 @@
+import csv
+import json
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .importers import CSV_CATEGORY_SEPARATOR
+from .models import Product, CartItem, Order, ShippingAddress
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+CONTENT_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+PRODUCT_EXPORT_FIELDS = ['id', 'name', 'description', 'price', 'amount_in_stock', 'image', 'category',
+                         'category_names']
+ORDER_EXPORT_FIELDS = ['id', 'created_date', 'paid_date', 'order_status', 'paid', 'total_price', 'customer',
+                       'customer_email', 'shipping_address', 'lines']
+# CSV has one row per line item, the order columns repeated on each
+ORDER_CSV_FIELDS = ORDER_EXPORT_FIELDS[:-1] + ['product', 'name', 'price', 'amount', 'total']
+ORDER_STATUSES = dict(Order.ORDER_STATUS_CHOICES)
+
+
+class Echo:
+    # csv.writer needs a file object; this one hands each formatted line straight back
+    def write(self, value):
+        return value
+
+
+def chunked(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def csv_lines(fields, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_lines(file_format, fields, rows):
+    if file_format == 'csv':
+        return csv_lines(fields, rows)
+    return ndjson_lines(rows)
+
+
+def product_rows(chunk_size=1000):
+    products = Product.objects.order_by('id').values('id', 'name', 'description', 'price', 'amount_in_stock', 'image')
+    for chunk in chunked(products.iterator(chunk_size=chunk_size), chunk_size):
+        categories = {}
+        links = Product.category.through.objects.filter(product_id__in=[row['id'] for row in chunk]) \
+            .order_by('category_id').values_list('product_id', 'category_id', 'category__name')
+        for product_id, category_id, name in links:
+            categories.setdefault(product_id, []).append((category_id, name))
+        for row in chunk:
+            row['category'] = [category_id for category_id, _ in categories.get(row['id'], [])]
+            row['category_names'] = [name for _, name in categories.get(row['id'], [])]
+            yield row
+
+
+def product_csv_rows(rows):
+    for row in rows:
+        row['category'] = CSV_CATEGORY_SEPARATOR.join(str(category_id) for category_id in row['category'])
+        row['category_names'] = CSV_CATEGORY_SEPARATOR.join(row['category_names'])
+        yield row
+
+
+def export_products(file_format, chunk_size=1000):
+    rows = product_rows(chunk_size)
+    if file_format == 'csv':
+        rows = product_csv_rows(rows)
+    return export_lines(file_format, PRODUCT_EXPORT_FIELDS, rows)
+
+
+def cart_lines(cart_ids):
+    # Order.snapshot_lines for many carts in one query, for orders created before lines were frozen on them
+    lines = {}
+    items = CartItem.objects.filter(cart_id__in=cart_ids).order_by('id') \
+        .values_list('cart_id', 'product_id', 'product__name', 'product__price', 'amount', 'price')
+    for cart_id, product_id, name, price, amount, total in items:
+        lines.setdefault(cart_id, []).append({'product': product_id, 'name': name, 'price': str(price),
+                                              'amount': amount, 'total': str(total)})
+    return lines
+
+
+def order_rows(orders, chunk_size=1000):
+    # One dict per order in id order; customers, addresses and missing lines are fetched once per chunk
+    orders = orders.order_by('id').values('id', 'created_date', 'paid_date', 'order_status', 'paid', 'total_price',
+                                          'customer_id', 'shipping_address_id', 'product_list_id', 'lines')
+    for chunk in chunked(orders.iterator(chunk_size=chunk_size), chunk_size):
+        customers = {pk: (username, email) for pk, username, email in User.objects
+                     .filter(pk__in={row['customer_id'] for row in chunk}).values_list('pk', 'username', 'email')}
+        addresses = {address.pop('id'): address for address in ShippingAddress.objects
+                     .filter(pk__in={row['shipping_address_id'] for row in chunk})
+                     .values('id', 'street_address', 'city', 'state', 'zip_code')}
+        missing = cart_lines([row['product_list_id'] for row in chunk if not row['lines']])
+        for row in chunk:
+            customer, email = customers.get(row.pop('customer_id'), (None, None))
+            row.update(customer=customer, customer_email=email,
+                       order_status=ORDER_STATUSES[row['order_status']],
+                       shipping_address=addresses.get(row.pop('shipping_address_id')))
+            cart_id = row.pop('product_list_id')
+            row['lines'] = row['lines'] or missing.get(cart_id, [])
+            yield row
+
+
+def order_csv_rows(rows):
+    empty_line = dict.fromkeys(ORDER_CSV_FIELDS[len(ORDER_EXPORT_FIELDS) - 1:], '')
+    for row in rows:
+        address = row['shipping_address']
+        row['shipping_address'] = ', '.join(value for value in address.values() if value) if address else ''
+        for line in row.pop('lines') or [empty_line]:
+            yield dict(row, **line)
+
+
+def export_orders(file_format, orders, chunk_size=1000):
+    rows = order_rows(orders, chunk_size)
+    if file_format == 'csv':
+        return export_lines(file_format, ORDER_CSV_FIELDS, order_csv_rows(rows))
+    return export_lines(file_format, ORDER_EXPORT_FIELDS, rows)
@@ -0,0 +1,126 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .models import Product, Category
+
+FACETS_KEY = 'catalog:facets'
+# The cached counts are patched in place by the product signals; the timeout bounds any drift from
+# writes that bypass signals or race each other.
+FACETS_TIMEOUT = getattr(settings, 'FACETS_CACHE_TIMEOUT', 3600)
+PRICE_BANDS = getattr(settings, 'PRODUCT_PRICE_BANDS', ((0, 10), (10, 50), (50, 100), (100, None)))
+
+
+def band_label(low, high):
+    if high is None:
+        return '%s+' % low
+    return '%s-%s' % (low, high)
+
+
+def price_band(price):
+    for low, high in PRICE_BANDS:
+        if price >= Decimal(low) and (high is None or price < Decimal(high)):
+            return band_label(low, high)
+    return None
+
+
+def count_facets(queryset):
+    products = Product.objects.filter(id__in=queryset.values('id'))
+    aggregates = {
+        'count': Count('id'),
+        'in_stock': Count('id', filter=Q(amount_in_stock__gt=0)),
+        'out_of_stock': Count('id', filter=Q(amount_in_stock__lte=0)),
+    }
+    for low, high in PRICE_BANDS:
+        band = Q(price__gte=low) if high is None else Q(price__gte=low, price__lt=high)
+        aggregates[band_label(low, high)] = Count('id', filter=band)
+    totals = products.aggregate(**aggregates)
+    categories = Product.category.through.objects.filter(product__in=products) \
+        .values('category_id', 'category__name').annotate(count=Count('product_id')).order_by()
+    return {
+        'count': totals['count'],
+        'in_stock': totals['in_stock'],
+        'out_of_stock': totals['out_of_stock'],
+        'price': {band_label(low, high): totals[band_label(low, high)] for low, high in PRICE_BANDS},
+        'category': {row['category_id']: [row['category__name'], row['count']] for row in categories},
+    }
+
+
+def render_facets(counts):
+    return {
+        'count': counts['count'],
+        'category': [{'id': category_id, 'name': name, 'count': count}
+                     for category_id, (name, count) in sorted(counts['category'].items()) if count > 0],
+        'price': [{'band': band_label(low, high), 'min': low, 'max': high,
+                   'count': counts['price'][band_label(low, high)]} for low, high in PRICE_BANDS],
+        'stock': {'in_stock': counts['in_stock'], 'out_of_stock': counts['out_of_stock']},
+    }
+
+
+def get_facets(queryset):
+    return render_facets(count_facets(queryset))
+
+
+def get_catalog_facets():
+    counts = cache.get(FACETS_KEY)
+    if counts is None:
+        counts = count_facets(Product.objects.all())
+        cache.set(FACETS_KEY, counts, FACETS_TIMEOUT)
+    return render_facets(counts)
+
+
+def catalog_facets_cached():
+    return cache.get(FACETS_KEY) is not None
+
+
+def invalidate_catalog_facets():
+    cache.delete(FACETS_KEY)
+
+
+def product_delta(price, amount_in_stock, sign):
+    delta = {'count': sign, 'in_stock': 0, 'out_of_stock': 0, 'price': {}, 'category': {}}
+    delta['in_stock' if amount_in_stock > 0 else 'out_of_stock'] = sign
+    band = price_band(Decimal(str(price)))
+    if band:
+        delta['price'][band] = sign
+    return delta
+
+
+def category_delta(category_ids, sign):
+    return {'category': {category_id: sign for category_id in category_ids}}
+
+
+def apply_delta(delta):
+    counts = cache.get(FACETS_KEY)
+    if counts is None:
+        return
+    for key in ('count', 'in_stock', 'out_of_stock'):
+        counts[key] += delta.get(key, 0)
+    for band, change in delta.get('price', {}).items():
+        counts['price'][band] = counts['price'].get(band, 0) + change
+    missing = [category_id for category_id in delta.get('category', {}) if category_id not in counts['category']]
+    if missing:
+        for category in Category.objects.filter(id__in=missing):
+            counts['category'][category.id] = [category.name, 0]
+    for category_id, change in delta.get('category', {}).items():
+        if category_id in counts['category']:
+            counts['category'][category_id][1] += change
+    cache.set(FACETS_KEY, counts, FACETS_TIMEOUT)
+
+
+def rename_category(category):
+    counts = cache.get(FACETS_KEY)
+    if counts is None or category.id not in counts['category']:
+        return
+    counts['category'][category.id][0] = category.name
+    cache.set(FACETS_KEY, counts, FACETS_TIMEOUT)
+
+
+def remove_category(category_id):
+    counts = cache.get(FACETS_KEY)
+    if counts is None:
+        return
+    counts['category'].pop(category_id, None)
+    cache.set(FACETS_KEY, counts, FACETS_TIMEOUT)
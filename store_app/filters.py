@@ -1,18 +1,43 @@
+from django import forms
+from django.db.models import Exists, OuterRef
 from django_filters import rest_framework as filters
 from .models import Product, Order, Category, Cart
 
 
+class IntegerInFilter(filters.BaseInFilter, filters.NumberFilter):
+    field_class = forms.IntegerField
+
+
+def canonical_id_list(value):
+    # "2,01,2" and "1,2" select the same rows, so they share a cache key; anything else is left for the filter
+    # to reject
+    try:
+        ids = {int(part) for part in value.split(',') if part.strip()}
+    except ValueError:
+        return value
+    return ','.join(str(category_id) for category_id in sorted(ids))
+
+
 class ProductFilter(filters.FilterSet):
     name = filters.CharFilter(lookup_expr='icontains')
     min_price = filters.NumberFilter(field_name="price", lookup_expr='gte')
     max_price = filters.NumberFilter(field_name="price", lookup_expr='lte')
     price = filters.NumberFilter(field_name="price", lookup_expr='exact')
     category = filters.CharFilter(lookup_expr='icontains', field_name="category__name")
+    category_id = IntegerInFilter(method='filter_category_id')
+    # Comma separated id lists whose order and duplicates don't change the result (used for cache keys)
+    id_list_params = ('category_id',)
 
     class Meta:
         model = Product
         fields = ['name', 'price', 'category']
 
+    def filter_category_id(self, queryset, name, value):
+        # EXISTS on the (product_id, category_id) unique index: no join, so no duplicated products
+        links = Product.category.through.objects.filter(product_id=OuterRef('pk'),
+                                                        category_id__in=value)
+        return queryset.filter(Exists(links))
+
 
 class OrderFilter(filters.FilterSet):
     IN_PROCESS = 1
@@ -0,0 +1,82 @@
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+
+def stored_response(record, request_path):
+    if record.request_path != request_path:
+        return Response({'detail': 'This Idempotency-Key was already used for a different request'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    if record.status_code is None:
+        # the first request is still running; the client retries once it has finished
+        return Response({'detail': 'A request with this Idempotency-Key is still in progress'},
+                        status=status.HTTP_409_CONFLICT, headers={'Retry-After': '1'})
+    return Response(record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+
+def claim_key(user, key, request_path):
+    # Returns (record, None) when this request owns the key, or (None, response) to answer a retry with
+    IdempotencyKey.objects.filter(customer=user, key=key, expires_at__lte=timezone.now()).delete()
+    record = IdempotencyKey.objects.filter(customer=user, key=key).first()
+    if record is not None:
+        return None, stored_response(record, request_path)
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(customer=user, key=key, request_path=request_path,
+                                                   expires_at=timezone.now() + settings.IDEMPOTENCY_KEY_TTL)
+    except IntegrityError:
+        # a concurrent duplicate inserted the key first
+        return None, stored_response(IdempotencyKey.objects.get(customer=user, key=key), request_path)
+    return record, None
+
+
+def idempotent_response(request, handler, check_permissions=None):
+    key = request.META.get(IDEMPOTENCY_HEADER)
+    if not key or not request.user.is_authenticated:
+        # keys belong to a user; an anonymous request gets the view's own 401/403
+        return handler()
+    if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+        raise ValidationError({'Idempotency-Key': 'Ensure this header has no more than 255 characters.'})
+    if check_permissions is not None:
+        # nobody can hold a key on an object they aren't allowed to act on
+        check_permissions()
+    record, response = claim_key(request.user, key, request.path)
+    if response is not None:
+        return response
+    try:
+        response = handler()
+    except Exception:
+        # the request failed without a response to replay, so a retry should run it again
+        record.delete()
+        raise
+    if response.status_code >= 400:
+        # only a request that went through is replayed; a rejected one may succeed when it's retried
+        record.delete()
+        return response
+    record.status_code = response.status_code
+    # stored the way it was rendered, so a replay returns the same body as the first response
+    record.response = json.loads(JSONRenderer().render(response.data) or 'null')
+    record.save(update_fields=['status_code', 'response'])
+    return response
+
+
+class IdempotencyMixin:
+    # Replays the first response to a POST sent with an Idempotency-Key header instead of running it again
+    def check_idempotency_permissions(self):
+        # detail views run their object permission checks before the key is claimed
+        if (self.lookup_url_kwarg or self.lookup_field) in self.kwargs:
+            self.get_object()
+
+    def post(self, request, *args, **kwargs):
+        return idempotent_response(request, lambda: super(IdempotencyMixin, self).post(request, *args, **kwargs),
+                                   self.check_idempotency_permissions)
@@ -0,0 +1,91 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+VARIANT_DIR = 'images/variants'
+EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg', 'PNG': 'png'}
+
+_executor = None
+
+
+def get_variants():
+    return getattr(settings, 'PRODUCT_IMAGE_VARIANTS', {})
+
+
+def variant_name(image_name, variant):
+    # built from the whole relative path and extension, so a.jpg, a.png and x/a.jpg never share variants
+    root, extension = os.path.splitext(image_name)
+    image_format = get_variants()[variant]['format']
+    return '%s/%s_%s_%s.%s' % (VARIANT_DIR, root, extension.lstrip('.'), variant, EXTENSIONS[image_format])
+
+
+def variant_urls(image_name):
+    return {variant: default_storage.url(variant_name(image_name, variant)) for variant in get_variants()}
+
+
+def render_variant(original, size, image_format):
+    image = original.copy()
+    image.thumbnail(size)
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    content = BytesIO()
+    image.save(content, format=image_format, quality=getattr(settings, 'PRODUCT_IMAGE_QUALITY', 85))
+    return content.getvalue()
+
+
+def generate_variants(image_name, force=False):
+    targets = {variant: variant_name(image_name, variant) for variant in get_variants()}
+    if not force:
+        targets = {variant: name for variant, name in targets.items() if not default_storage.exists(name)}
+    if not targets:
+        return []
+    with default_storage.open(image_name) as source:
+        original = Image.open(source)
+        original.load()
+    for variant, name in targets.items():
+        options = get_variants()[variant]
+        content = render_variant(original, options['size'], options['format'])
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        default_storage.save(name, ContentFile(content))
+    return list(targets.values())
+
+
+def backfill_variants(image_name, force=False):
+    try:
+        return generate_variants(image_name, force)
+    except OSError:
+        logger.exception("Could not generate variants for %s", image_name)
+        return None
+
+
+def init_worker():
+    import django
+    django.setup()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=settings.PRODUCT_IMAGE_WORKERS, initializer=init_worker)
+    return _executor
+
+
+def log_failure(future):
+    if future.exception() is not None:
+        logger.error("Generating product image variants failed", exc_info=future.exception())
+
+
+def schedule_variants(image_name):
+    # Resizing runs in a process pool so neither the request thread nor the GIL pays for it
+    if not getattr(settings, 'PRODUCT_IMAGE_WORKERS', 0):
+        return generate_variants(image_name)
+    get_executor().submit(generate_variants, image_name).add_done_callback(log_failure)
@@ -0,0 +1,133 @@
+import csv
+import json
+from itertools import islice
+
+from django.db import transaction
+
+from . import search
+from .cache import bump_catalog_version
+from .facets import invalidate_catalog_facets
+from .models import Product, Category
+from .serializers import ProductImportSerializer
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+PRODUCT_FIELDS = ['name', 'description', 'price', 'amount_in_stock']
+# CSV rows list several category ids in one column, e.g. "1|4"
+CSV_CATEGORY_SEPARATOR = '|'
+
+
+def read_csv_rows(stream):
+    for row in csv.DictReader(stream):
+        row = {key: value for key, value in row.items() if key and value not in (None, '')}
+        if 'category' in row:
+            row['category'] = [value for value in row['category'].split(CSV_CATEGORY_SEPARATOR) if value]
+        yield row
+
+
+def read_jsonl_rows(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def read_rows(stream, file_format):
+    if file_format == 'csv':
+        return read_csv_rows(stream)
+    return read_jsonl_rows(stream)
+
+
+class ProductImporter:
+    # Imports products in batches: each batch is validated row by row, checked against the database with one
+    # category query and one product query, then written with bulk_create/bulk_update. Invalid rows are
+    # reported and skipped without failing the rest of the batch.
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+
+    def run(self, rows):
+        numbered_rows = enumerate(rows, start=1)
+        while True:
+            batch = list(islice(numbered_rows, self.batch_size))
+            if not batch:
+                break
+            self.import_batch(batch)
+        if self.created or self.updated:
+            bump_catalog_version()
+            invalidate_catalog_facets()
+        return self.report()
+
+    def report(self):
+        return {'created': self.created, 'updated': self.updated, 'errors': self.errors}
+
+    def validate_batch(self, batch):
+        valid = []
+        for row_number, row in batch:
+            if not isinstance(row, dict):
+                self.errors.append({'row': row_number, 'errors': {'non_field_errors': ['Row is not a JSON object']}})
+                continue
+            # rows with an id update an existing product and only need the fields they change
+            serializer = ProductImportSerializer(data=row, partial='id' in row)
+            if serializer.is_valid():
+                valid.append((row_number, serializer.validated_data))
+            else:
+                self.errors.append({'row': row_number, 'errors': serializer.errors})
+        category_ids = {category_id for _, data in valid for category_id in data.get('category', [])}
+        existing_categories = set(Category.objects.filter(id__in=category_ids).values_list('id', flat=True))
+        product_ids = {data['id'] for _, data in valid if 'id' in data}
+        existing_products = Product.objects.in_bulk(product_ids)
+        checked = []
+        for row_number, data in valid:
+            missing = set(data.get('category', [])) - existing_categories
+            if missing:
+                self.errors.append({'row': row_number, 'errors': {
+                    'category': ['Category %s does not exist' % category_id for category_id in sorted(missing)]}})
+            elif 'id' in data and data['id'] not in existing_products:
+                self.errors.append({'row': row_number, 'errors': {'id': ['Product %s does not exist' % data['id']]}})
+            else:
+                checked.append(data)
+        return checked, existing_products
+
+    def import_batch(self, batch):
+        rows, existing_products = self.validate_batch(batch)
+        new_products = []
+        new_categories = []
+        updated_products = {}
+        updated_fields = {}
+        updated_categories = {}
+        for data in rows:
+            if 'id' in data:
+                product = existing_products[data['id']]
+                fields = [field for field in PRODUCT_FIELDS if field in data]
+                for field in fields:
+                    setattr(product, field, data[field])
+                updated_products[product.id] = product
+                updated_fields.setdefault(tuple(fields), []).append(product)
+                if 'category' in data:
+                    updated_categories[product.id] = data['category']
+            else:
+                new_products.append(Product(**{field: data[field] for field in PRODUCT_FIELDS}))
+                new_categories.append(data.get('category', []))
+        through = Product.category.through
+        with transaction.atomic():
+            Product.objects.bulk_create(new_products, batch_size=self.batch_size)
+            # one bulk_update per set of columns, so a field missing from a row is never written back
+            for fields, products in updated_fields.items():
+                if fields:
+                    Product.objects.bulk_update(products, fields, batch_size=self.batch_size)
+            through.objects.filter(product_id__in=updated_categories.keys()).delete()
+            links = [through(product_id=product.id, category_id=category_id)
+                     for product, category_ids in zip(new_products, new_categories) for category_id in category_ids]
+            links += [through(product_id=product_id, category_id=category_id)
+                      for product_id, category_ids in updated_categories.items() for category_id in category_ids]
+            through.objects.bulk_create(links, batch_size=self.batch_size, ignore_conflicts=True)
+            search.index_products(new_products + list(updated_products.values()))
+        self.created += len(new_products)
+        self.updated += len(updated_products)
@@ -0,0 +1,99 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+
+from .models import Job
+from .payments import pay_order
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {
+    Job.ORDER_PAYMENT: lambda payload: pay_order(payload['order']),
+}
+
+
+def to_json(data):
+    # Rendered the way a response would be, so a job result reads the same as the endpoint it replaces
+    return json.loads(JSONRenderer().render(data) or 'null')
+
+
+def init_worker():
+    # run_workers --processes: a worker process sets Django up itself rather than relying on what it forked from
+    import django
+    django.setup()
+
+
+def enqueue(kind, payload, user=None):
+    return Job.objects.create(kind=kind, payload=payload, created_by=user)
+
+
+def requeue_abandoned():
+    # Jobs left running by a worker that died; a handler commits together with its result, so rerunning is safe
+    started_before = timezone.now() - settings.JOB_TIMEOUT
+    return Job.objects.filter(status=Job.RUNNING, started_at__lt=started_before) \
+        .update(status=Job.QUEUED, started_at=None)
+
+
+def purge_finished(batch_size=1000):
+    # Deletes done and failed jobs older than JOB_RETENTION, in batches; returns how many went
+    finished_before = timezone.now() - settings.JOB_RETENTION
+    purged = 0
+    while True:
+        ids = list(Job.objects.filter(status__in=(Job.DONE, Job.FAILED), finished_at__lt=finished_before)
+                   .values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += Job.objects.filter(pk__in=ids).delete()[0]
+
+
+def claim_job():
+    # Claimed with a conditional UPDATE, so two workers that pick the same row can't both run it
+    while True:
+        job_id = Job.objects.filter(status=Job.QUEUED).order_by('id').values_list('id', flat=True).first()
+        if job_id is None:
+            return None
+        if Job.objects.filter(pk=job_id, status=Job.QUEUED) \
+                .update(status=Job.RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1):
+            return Job.objects.get(pk=job_id)
+
+
+def run_job(job):
+    try:
+        with transaction.atomic():
+            job.result = to_json(HANDLERS[job.kind](job.payload))
+            job.status = Job.DONE
+            job.finished_at = timezone.now()
+            job.save(update_fields=['result', 'status', 'finished_at'])
+    except APIException as exc:
+        job.result = to_json({'status_code': exc.status_code, 'detail': exc.detail})
+        job.status = Job.FAILED
+    except Exception:
+        logger.exception("Job %s (%s) failed", job.pk, job.kind)
+        job.result = {'status_code': 500, 'detail': 'The job failed unexpectedly'}
+        job.status = Job.FAILED
+    if job.status == Job.FAILED:
+        job.finished_at = timezone.now()
+        job.save(update_fields=['result', 'status', 'finished_at'])
+    return job
+
+
+def work(burst=False, poll_interval=None):
+    # Runs jobs until the queue is empty (burst) or forever, sleeping between polls while it's idle
+    poll_interval = settings.JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+    processed = 0
+    while True:
+        job = claim_job()
+        if job is None:
+            if burst:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        processed += 1
@@ -0,0 +1,41 @@
+from rest_framework.generics import get_object_or_404
+
+from .models import Product, CartItem
+
+
+class RequestLoader:
+    # Identity map for one request: views and serializers read products and cart items through it,
+    # so each object is fetched at most once however many layers look it up.
+
+    def __init__(self):
+        self.products = {}
+        self.cart_items = {}
+
+    def add_product(self, product):
+        self.products[product.pk] = product
+        return product
+
+    def add_cart_item(self, cart_item):
+        self.cart_items[cart_item.pk] = cart_item
+        if CartItem.product.is_cached(cart_item):
+            self.add_product(cart_item.product)
+        return cart_item
+
+    def product(self, pk):
+        pk = int(pk)
+        if pk not in self.products:
+            self.add_product(get_object_or_404(Product, pk=pk))
+        return self.products[pk]
+
+    def cart_item(self, pk):
+        pk = int(pk)
+        if pk not in self.cart_items:
+            self.add_cart_item(get_object_or_404(CartItem.objects.select_related('product'), pk=pk))
+        return self.cart_items[pk]
+
+
+def get_loader(request):
+    loader = getattr(request, '_store_loader', None)
+    if loader is None:
+        loader = request._store_loader = RequestLoader()
+    return loader
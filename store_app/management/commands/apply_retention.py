@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from store_app import retention
+
+
+class Command(BaseCommand):
+    help = "Archive old delivered orders and purge abandoned carts and expired cards, a chunk at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order-days', type=int, default=settings.ORDER_RETENTION_DAYS,
+                            help="Archive received/delivered orders created more than this many days ago")
+        parser.add_argument('--cart-days', type=int, default=settings.ABANDONED_CART_DAYS,
+                            help="Purge open carts untouched for this many days")
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be archived or purged")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        order_before = now - timedelta(days=options['order_days'])
+        cart_before = now - timedelta(days=options['cart_days'])
+        today = timezone.localdate()
+        if options['dry_run']:
+            self.stdout.write("Would archive %s orders" % retention.orders_to_archive(order_before).count())
+            self.stdout.write("Would purge %s abandoned carts" % retention.abandoned_carts(cart_before).count())
+            self.stdout.write("Would purge %s expired payment details"
+                              % retention.expired_payment_details(today).count())
+            return
+        # orders go first so cards only they referenced are purged in the same run
+        steps = (
+            ("Archived %s orders", retention.archive_orders(order_before, options['chunk_size'])),
+            ("Purged %s abandoned carts", retention.purge_abandoned_carts(cart_before, options['chunk_size'])),
+            ("Purged %s expired payment details",
+             retention.purge_expired_payment_details(today, options['chunk_size'])),
+        )
+        totals = []
+        for message, chunks in steps:
+            total = 0
+            for count in chunks:
+                total += count
+                self.stdout.write(message % total + " so far")
+            totals.append(total)
+        self.stdout.write(self.style.SUCCESS("Archived %s orders, purged %s abandoned carts and %s expired payment "
+                                             "details" % tuple(totals)))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from store_app.exporters import export_products, EXPORT_FORMATS
+
+
+class Command(BaseCommand):
+    help = "Stream the whole product catalog as CSV or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--output', help="File to write to, stdout when omitted")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        lines = export_products(options['format'], chunk_size=options['chunk_size'])
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+            output.writelines(lines)
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from store_app import images
+from store_app.models import Product
+
+
+class Command(BaseCommand):
+    help = "Generate the resized/WebP variants for product images that do not have them yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all-files', action='store_true',
+                            help="Process every file in the images directory, not only the ones products use")
+        parser.add_argument('--force', action='store_true', help="Regenerate variants that already exist")
+
+    def image_names(self, all_files):
+        if all_files:
+            _, files = default_storage.listdir('images')
+            return sorted('images/%s' % name for name in files)
+        return list(Product.objects.exclude(image='').exclude(image__isnull=True)
+                    .order_by('image').values_list('image', flat=True).distinct())
+
+    def handle(self, *args, **options):
+        names = self.image_names(options['all_files'])
+        force = [options['force']] * len(names)
+        if settings.PRODUCT_IMAGE_WORKERS:
+            results = images.get_executor().map(images.backfill_variants, names, force)
+        else:
+            results = map(images.backfill_variants, names, force)
+        generated = 0
+        for name, variants in zip(names, results):
+            if variants is None:
+                self.stderr.write("%s: not a readable image" % name)
+                continue
+            generated += len(variants)
+            self.stdout.write("%s: %s variants" % (name, len(variants)))
+        self.stdout.write(self.style.SUCCESS("Generated %s variants for %s images" % (generated, len(names))))
@@ -0,0 +1,28 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store_app.importers import ProductImporter, read_rows, IMPORT_FORMATS
+
+
+class Command(BaseCommand):
+    help = "Import products from a CSV or JSONL file. Rows with an id update that product, others create one"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=IMPORT_FORMATS,
+                            help="Input format, guessed from the file extension when omitted")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format not in IMPORT_FORMATS:
+            raise CommandError("Unknown format %s, use --format" % file_format)
+        importer = ProductImporter(batch_size=options['batch_size'])
+        with open(path, newline='', encoding='utf-8') as stream:
+            report = importer.run(read_rows(stream, file_format))
+        for error in report['errors']:
+            self.stderr.write("Row %s: %s" % (error['row'], error['errors']))
+        self.stdout.write(self.style.SUCCESS("Created %s, updated %s, rejected %s products" % (
+            report['created'], report['updated'], len(report['errors']))))
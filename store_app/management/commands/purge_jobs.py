@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store_app import jobs
+
+
+class Command(BaseCommand):
+    help = "Delete finished background jobs and their results once they are past JOB_RETENTION, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        purged = jobs.purge_finished(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("Purged %s finished jobs" % purged))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, Count
+
+from store_app.models import Product, Feedback
+
+
+class Command(BaseCommand):
+    help = "Recalculate Product.rating_sum and Product.rating_count from the feedback table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        updated = 0
+        while True:
+            products = list(Product.objects.filter(id__gt=last_id).order_by('id').only('id')[:chunk_size])
+            if not products:
+                break
+            last_id = products[-1].id
+            ratings = Feedback.objects.filter(product__in=products, rate__isnull=False) \
+                .values('product_id').annotate(rate_sum=Sum('rate'), rate_count=Count('id'))
+            ratings = {row['product_id']: row for row in ratings}
+            for product in products:
+                row = ratings.get(product.id)
+                product.rating_sum = row['rate_sum'] if row else 0
+                product.rating_count = row['rate_count'] if row else 0
+            with transaction.atomic():
+                Product.objects.bulk_update(products, ['rating_sum', 'rating_count'])
+            updated += len(products)
+            self.stdout.write("Updated %s products" % updated)
+        self.stdout.write(self.style.SUCCESS("Product ratings rebuilt"))
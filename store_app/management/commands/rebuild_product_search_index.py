@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store_app import search
+from store_app.cache import bump_catalog_version
+from store_app.models import Product
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index over product names and descriptions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not search.fts_available():
+            self.stdout.write(self.style.WARNING("Full-text search is only available on SQLite, nothing to rebuild"))
+            return
+        chunk_size = options['chunk_size']
+        last_id = 0
+        indexed = 0
+        with transaction.atomic():
+            search.clear_index()
+            while True:
+                products = list(Product.objects.filter(id__gt=last_id).order_by('id')
+                                .only('id', 'name', 'description')[:chunk_size])
+                if not products:
+                    break
+                last_id = products[-1].id
+                search.index_products(products)
+                indexed += len(products)
+                self.stdout.write("Indexed %s products" % indexed)
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS("Product search index rebuilt"))
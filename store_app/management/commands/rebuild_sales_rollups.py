@@ -0,0 +1,39 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from store_app.models import Order, ArchivedOrder
+from store_app.reports import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Recompute the daily sales rollups from paid orders, a chunk of days at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help="First day, YYYY-MM-DD (default: first sale)")
+        parser.add_argument('--end', type=date.fromisoformat, help="Last day, YYYY-MM-DD (default: today)")
+        parser.add_argument('--chunk-days', type=int, default=7)
+
+    def handle(self, *args, **options):
+        end = options['end'] or timezone.localdate()
+        start = options['start']
+        if start is None:
+            first_sales = [model.objects.filter(paid=True).aggregate(first=Min('paid_date'))['first']
+                           for model in (Order, ArchivedOrder)]
+            first_sale = min((day for day in first_sales if day is not None), default=None)
+            if first_sale is None:
+                self.stdout.write(self.style.SUCCESS("No paid orders to roll up"))
+                return
+            start = timezone.localdate(first_sale)
+        if start > end:
+            raise CommandError("--start must not be after --end")
+        total = 0
+        while start <= end:
+            chunk_end = min(start + timedelta(days=options['chunk_days'] - 1), end)
+            orders = rebuild_rollups(start, chunk_end)
+            total += orders
+            self.stdout.write("%s..%s: %s orders" % (start, chunk_end, orders))
+            start = chunk_end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS("Sales rollups rebuilt from %s orders" % total))
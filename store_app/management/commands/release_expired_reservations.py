@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store_app.models import StockReservation
+
+
+class Command(BaseCommand):
+    help = "Delete stock reservations whose hold has expired, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        released = StockReservation.objects.release_expired(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("Released %s expired stock reservations" % released))
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from store_app import jobs
+
+
+def work(burst, poll_interval):
+    try:
+        return jobs.work(burst, poll_interval)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Run background jobs such as order payments from the database queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.JOB_WORKERS,
+                            help="Number of workers; 0 runs jobs in this process")
+        parser.add_argument('--processes', action='store_true', help="Use worker processes instead of threads")
+        parser.add_argument('--burst', action='store_true', help="Exit once the queue is empty")
+        parser.add_argument('--poll-interval', type=float, default=settings.JOB_POLL_INTERVAL)
+
+    def handle(self, *args, **options):
+        requeued = jobs.requeue_abandoned()
+        if requeued:
+            self.stdout.write("Requeued %s abandoned jobs" % requeued)
+        workers = options['workers']
+        if not workers:
+            processed = jobs.work(options['burst'], options['poll_interval'])
+        else:
+            if options['processes']:
+                # forked workers must open their own connections rather than share this one
+                connection.close()
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=jobs.init_worker)
+            else:
+                executor = ThreadPoolExecutor(max_workers=workers)
+            with executor:
+                futures = [executor.submit(work, options['burst'], options['poll_interval']) for _ in range(workers)]
+                processed = sum(future.result() for future in futures)
+        self.stdout.write(self.style.SUCCESS("Processed %s jobs" % processed))
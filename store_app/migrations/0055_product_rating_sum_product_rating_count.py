@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:04
+
+from django.db import migrations, models
+from django.db.models import Sum, Count
+
+
+def fill_product_ratings(apps, schema_editor):
+    Product = apps.get_model('store_app', 'Product')
+    Feedback = apps.get_model('store_app', 'Feedback')
+    ratings = Feedback.objects.filter(rate__isnull=False).values('product_id') \
+        .annotate(rate_sum=Sum('rate'), rate_count=Count('id'))
+    for row in ratings:
+        Product.objects.filter(pk=row['product_id']).update(rating_sum=row['rate_sum'],
+                                                            rating_count=row['rate_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0054_alter_order_created_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='feedback',
+            name='rate',
+            field=models.IntegerField(choices=[(5, 'excellent'), (4, 'very good'), (3, 'good'), (2, 'not bad'), (1, 'bad')], null=True),
+        ),
+        migrations.RunPython(fill_product_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+# kept literal rather than imported from store_app.search so later changes there can't alter this migration
+FTS_TABLE = 'store_app_product_fts'
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(name, description)" % FTS_TABLE)
+    Product = apps.get_model('store_app', 'Product')
+    rows = Product.objects.values_list('id', 'name', 'description')
+    schema_editor.connection.cursor().executemany(
+        "INSERT INTO %s (rowid, name, description) VALUES (%%s, %%s, %%s)" % FTS_TABLE, list(rows))
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS %s" % FTS_TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0055_product_rating_sum_product_rating_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0056_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='category',
+            options={'ordering': ['id']},
+        ),
+    ]
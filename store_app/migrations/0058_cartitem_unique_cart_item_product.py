@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:17
+
+from django.db import migrations, models
+from django.db.models import Count, Sum, Min
+
+
+def merge_duplicate_cart_items(apps, schema_editor):
+    CartItem = apps.get_model('store_app', 'CartItem')
+    duplicates = CartItem.objects.values('cart_id', 'product_id').annotate(
+        lines=Count('id'), first_id=Min('id'), amount_sum=Sum('amount'), price_sum=Sum('price')).filter(lines__gt=1)
+    for row in duplicates:
+        CartItem.objects.filter(pk=row['first_id']).update(amount=row['amount_sum'], price=row['price_sum'])
+        CartItem.objects.filter(cart_id=row['cart_id'], product_id=row['product_id']) \
+            .exclude(pk=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0057_alter_category_options'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cart_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_item_product'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:23
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum, Count
+
+
+def fill_cart_counters(apps, schema_editor):
+    Cart = apps.get_model('store_app', 'Cart')
+    CartItem = apps.get_model('store_app', 'CartItem')
+    counters = CartItem.objects.values('cart_id').annotate(items=Sum('amount'), lines=Count('id'))
+    for row in counters:
+        Cart.objects.filter(pk=row['cart_id']).update(item_count=max(row['items'], 0), distinct_products=row['lines'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0059_stockreservation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='distinct_products',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['customer', 'status'], name='cart_customer_status'),
+        ),
+        migrations.RunPython(fill_cart_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:32
+
+from django.db import migrations, models
+
+CHUNK_SIZE = 500
+
+
+def fill_order_lines(apps, schema_editor):
+    # Backfilled from the carts as they are now; orders placed from here on are frozen at creation
+    Order = apps.get_model('store_app', 'Order')
+    CartItem = apps.get_model('store_app', 'CartItem')
+    last_id = 0
+    while True:
+        orders = list(Order.objects.filter(id__gt=last_id).order_by('id').only('id', 'product_list_id')[:CHUNK_SIZE])
+        if not orders:
+            break
+        last_id = orders[-1].id
+        lines = {}
+        items = CartItem.objects.filter(cart_id__in=[order.product_list_id for order in orders]).order_by('id') \
+            .values_list('cart_id', 'product_id', 'product__name', 'product__price', 'amount', 'price')
+        for cart_id, product_id, name, price, amount, total in items:
+            lines.setdefault(cart_id, []).append({'product': product_id, 'name': name, 'price': str(price),
+                                                  'amount': amount, 'total': str(total)})
+        for order in orders:
+            order.lines = lines.get(order.product_list_id, [])
+        Order.objects.bulk_update(orders, ['lines'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0062_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='lines',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(fill_order_lines, migrations.RunPython.noop),
+    ]
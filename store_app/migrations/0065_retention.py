@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:36
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0064_sales_rollups'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.PositiveIntegerField(unique=True)),
+                ('order_status', models.IntegerField(choices=[(1, 'Completed. Payment in process'), (2, 'Not completed yet. Make sure payment_details and shipping_address are added'), (3, 'Paid. In process'), (4, "Sent to customer's shipping address"), (5, 'Delivered'), (6, 'Received')])),
+                ('total_price', models.DecimalField(decimal_places=2, default=0, max_digits=7)),
+                ('paid', models.BooleanField(default=False)),
+                ('created_date', models.DateTimeField(blank=True, null=True)),
+                ('paid_date', models.DateTimeField(blank=True, null=True)),
+                ('lines', models.JSONField(blank=True, default=list)),
+                ('shipping_address', models.JSONField(blank=True, null=True)),
+                ('archived_date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='updated_date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['status', 'updated_date'], name='cart_status_updated'),
+        ),
+        migrations.AddField(
+            model_name='archivedorder',
+            name='customer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['customer', '-created_date'], name='archived_order_customer'),
+        ),
+    ]
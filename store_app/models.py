@@ -1,6 +1,8 @@
+from django.conf import settings
 from django.db import models
 from django.core.exceptions import ValidationError
-from django.db.models import Sum
+from django.db.models import Sum, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
 from django.utils import timezone, dateformat
 from django.utils.translation import gettext_lazy as _
 
@@ -16,6 +18,9 @@ def validate_above_zero(value):
 class Category(models.Model):
     name = models.TextField()
 
+    class Meta:
+        ordering = ['id']
+
     def __str__(self):
         return self.name
 
@@ -27,6 +32,25 @@ class Product(models.Model):
     amount_in_stock = models.IntegerField(validators=[validate_above_zero])
     image = models.ImageField(upload_to='images/', blank=True, null=True)
     category = models.ManyToManyField(Category, related_name='product', blank=True, null=True)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+
+    @property
+    def feedback_rate(self):
+        if not self.rating_count:
+            return None
+        return self.rating_sum / self.rating_count
+
+    @classmethod
+    def change_rating(cls, product_id, old_rate=None, new_rate=None):
+        # Keeps rating_sum/rating_count in step with the feedback table without re-aggregating it.
+        # Clamped at zero so rows that drifted before a rebuild_product_ratings run never block a write.
+        sum_delta = (new_rate or 0) - (old_rate or 0)
+        count_delta = (new_rate is not None) - (old_rate is not None)
+        if not sum_delta and not count_delta:
+            return
+        cls.objects.filter(pk=product_id).update(rating_sum=Greatest(F('rating_sum') + sum_delta, 0),
+                                                 rating_count=Greatest(F('rating_count') + count_delta, 0))
 
 
 class Cart(models.Model):
@@ -41,6 +65,26 @@ class Cart(models.Model):
     customer = models.ForeignKey('auth.User', on_delete=models.CASCADE)
     status = models.CharField(choices=STATUS_CHOICES, default='O', max_length=1)
     total_price = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    # kept in step with the cart's lines by change_totals so the summary never touches CartItem
+    item_count = models.PositiveIntegerField(default=0)
+    distinct_products = models.PositiveIntegerField(default=0)
+    # last change to the cart's lines; open carts left untouched long enough are purged by apply_retention
+    updated_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer', 'status'], name='cart_customer_status'),
+            models.Index(fields=['status', 'updated_date'], name='cart_status_updated'),
+        ]
+
+    @classmethod
+    def change_totals(cls, cart_id, price=0, items=0, lines=0):
+        # Applied in SQL so concurrent writes to the same cart can't overwrite each other.
+        # The counters are clamped at zero like Product.change_rating, for lines written outside these views.
+        cls.objects.filter(pk=cart_id).update(total_price=F('total_price') + price,
+                                              item_count=Greatest(F('item_count') + items, 0),
+                                              distinct_products=Greatest(F('distinct_products') + lines, 0),
+                                              updated_date=timezone.now())
 
     def calculate_total_price(self):
         return CartItem.objects.filter(cart=self).aggregate(Sum('price'))
@@ -52,11 +96,85 @@ class CartItem(models.Model):
     price = models.DecimalField(max_digits=7, decimal_places=2, default=0)
     cart = models.ForeignKey(Cart, related_name="cart_items", on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_item_product'),
+        ]
+
     @property
     def total(self):
         return self.amount*self.product.price
 
 
+class StockReservationManager(models.Manager):
+    def active(self):
+        return self.filter(expires_at__gt=timezone.now())
+
+    def reserved(self, product_ids, exclude_cart_id=None):
+        # One grouped sum over the (product, expires_at) index instead of walking cart lines
+        reservations = self.active().filter(product_id__in=product_ids)
+        if exclude_cart_id is not None:
+            reservations = reservations.exclude(cart_id=exclude_cart_id)
+        rows = reservations.values('product_id').annotate(reserved=Sum('amount')).values_list('product_id', 'reserved')
+        return dict(rows)
+
+    def available(self, product, exclude_cart_id=None):
+        return product.amount_in_stock - self.reserved([product.pk], exclude_cart_id).get(product.pk, 0)
+
+    def hold_many(self, cart_id, amounts):
+        # Sets the cart's hold on each product to the given quantity and returns the ids that are short.
+        # Must run inside a transaction: the product rows are locked so two carts can't claim the same units.
+        if not amounts:
+            return []
+        held_elsewhere = self.active().filter(product=OuterRef('pk')).exclude(cart_id=cart_id) \
+            .values('product').annotate(total=Sum('amount')).values('total')
+        available = dict(Product.objects.select_for_update().filter(pk__in=amounts).order_by('pk')
+                         .annotate(reserved=Coalesce(Subquery(held_elsewhere), 0))
+                         .values_list('pk', F('amount_in_stock') - F('reserved')))
+        short = [product_id for product_id, amount in amounts.items() if available.get(product_id, 0) < amount]
+        if short:
+            return short
+        expires_at = timezone.now() + settings.STOCK_RESERVATION_TTL
+        self.filter(cart_id=cart_id, product_id__in=amounts).delete()
+        self.bulk_create([self.model(cart_id=cart_id, product_id=product_id, amount=amount, expires_at=expires_at)
+                          for product_id, amount in amounts.items()])
+        return []
+
+    def hold(self, cart_id, product_id, amount):
+        return not self.hold_many(cart_id, {product_id: amount})
+
+    def release(self, cart_id, product_ids=None):
+        reservations = self.filter(cart_id=cart_id)
+        if product_ids is not None:
+            reservations = reservations.filter(product_id__in=product_ids)
+        return reservations.delete()[0]
+
+    def release_expired(self, batch_size=1000):
+        released = 0
+        while True:
+            ids = list(self.filter(expires_at__lte=timezone.now()).values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return released
+            released += self.filter(pk__in=ids).delete()[0]
+
+
+class StockReservation(models.Model):
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    cart = models.ForeignKey(Cart, related_name='reservations', on_delete=models.CASCADE)
+    amount = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = StockReservationManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_stock_reservation'),
+        ]
+        indexes = [
+            models.Index(fields=['product', 'expires_at'], name='stock_reservation_active'),
+        ]
+
+
 class PaymentDetails(models.Model):
     card_number = models.CharField(max_length=16)
     cvv = models.CharField(max_length=3)
@@ -89,6 +207,13 @@ class Order(models.Model):
         (DELIVERED, "Delivered"),
         (RECEIVED, "Received"),
     )
+    # target status: the statuses an order may move to it from. Orders only become IN_PROCESS once an address
+    # and a card are added, and PAID through payments.pay_order, so neither can be set directly.
+    ALLOWED_TRANSITIONS = {
+        SENT: (PAID,),
+        DELIVERED: (SENT,),
+        RECEIVED: (SENT, DELIVERED),
+    }
 
     customer = models.ForeignKey('auth.User', on_delete=models.CASCADE)
     product_list = models.OneToOneField(Cart, related_name="cart", on_delete=models.CASCADE)
@@ -99,6 +224,36 @@ class Order(models.Model):
     order_status = models.IntegerField(choices=ORDER_STATUS_CHOICES, default=NOT_COMPLETED)
     paid = models.BooleanField(default=False)
     created_date = models.DateTimeField(default=timezone.now, blank=True, null=True)
+    paid_date = models.DateTimeField(null=True, blank=True, db_index=True)
+    # what was bought, frozen when the order is placed: product, name, unit price, amount and line total
+    lines = models.JSONField(default=list, blank=True)
+
+    @staticmethod
+    def snapshot_lines(cart_id):
+        items = CartItem.objects.filter(cart_id=cart_id).order_by('id') \
+            .values_list('product_id', 'product__name', 'product__price', 'amount', 'price')
+        return [{'product': product_id, 'name': name, 'price': str(price), 'amount': amount, 'total': str(total)}
+                for product_id, name, price, amount, total in items]
+
+
+class ArchivedOrder(models.Model):
+    # A delivered or received order moved out of Order by apply_retention, with everything needed to show it.
+    # Card details are not copied.
+    order_id = models.PositiveIntegerField(unique=True)
+    customer = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+    order_status = models.IntegerField(choices=Order.ORDER_STATUS_CHOICES)
+    total_price = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    paid = models.BooleanField(default=False)
+    created_date = models.DateTimeField(null=True, blank=True)
+    paid_date = models.DateTimeField(null=True, blank=True)
+    lines = models.JSONField(default=list, blank=True)
+    shipping_address = models.JSONField(null=True, blank=True)
+    archived_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer', '-created_date'], name='archived_order_customer'),
+        ]
 
 
 class Feedback(models.Model):
@@ -113,3 +268,89 @@ class Feedback(models.Model):
     customer = models.ForeignKey('auth.User', on_delete=models.CASCADE)
     rate = models.IntegerField(choices=RATE_CHOICES, null=True)
     text = models.TextField(blank=True, null=True)
+
+
+class IdempotencyKey(models.Model):
+    # The first response to a request sent with an Idempotency-Key header, replayed to retries until it expires.
+    # A row without a status_code belongs to a request that is still running.
+    customer = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    request_path = models.CharField(max_length=255)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'key'], name='unique_idempotency_key'),
+        ]
+
+
+class Job(models.Model):
+    # A unit of background work, claimed and run by manage.py run_workers
+    ORDER_PAYMENT = 'order_payment'
+    KIND_CHOICES = (
+        (ORDER_PAYMENT, 'Order payment'),
+    )
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    kind = models.CharField(choices=KIND_CHOICES, max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(choices=STATUS_CHOICES, default=QUEUED, max_length=10)
+    result = models.JSONField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_by = models.ForeignKey('auth.User', on_delete=models.CASCADE, null=True, blank=True)
+    created_date = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='job_queue'),
+            models.Index(fields=['status', 'finished_at'], name='job_finished'),
+        ]
+
+
+class SalesRollup(models.Model):
+    # Paid orders summed per day, kept current by store_app.reports.record_sale and rebuilt by rebuild_sales_rollups
+    date = models.DateField()
+    revenue = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    units = models.PositiveBigIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class DailySales(SalesRollup):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date'], name='unique_daily_sales'),
+        ]
+
+
+class DailyProductSales(SalesRollup):
+    # no FK constraint, so history survives a product being deleted
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'product'], name='unique_daily_product_sales'),
+        ]
+
+
+class DailyCategorySales(SalesRollup):
+    category = models.ForeignKey(Category, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'category'], name='unique_daily_category_sales'),
+        ]
@@ -0,0 +1,23 @@
+from rest_framework.pagination import CursorPagination
+
+
+class StoreCursorPagination(CursorPagination):
+
+    def __init__(self, ordering):
+        self.ordering = ordering
+
+
+class CursorPaginationMixin:
+    # Opt-in keyset paging: ?pagination=cursor returns the first page, then clients follow next/previous.
+    # Pages are filtered on cursor_ordering, so there is no OFFSET scan and no COUNT query.
+    cursor_ordering = ('id',)
+
+    def use_cursor_pagination(self):
+        query_params = self.request.query_params
+        return query_params.get('pagination') == 'cursor' or StoreCursorPagination.cursor_query_param in query_params
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator') and self.use_cursor_pagination():
+            self._paginator = StoreCursorPagination(self.cursor_ordering)
+        return super().paginator
@@ -0,0 +1,81 @@
+from django.db import transaction
+from django.db.models import F
+from django.forms import model_to_dict
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .cache import bump_catalog_version
+from .facets import invalidate_catalog_facets
+from .models import Cart, CartItem, Product, Order, StockReservation
+from .reports import record_sale
+
+
+def decrement_stock(order):
+    # Must run inside a transaction
+    cart = Cart.objects.select_for_update().get(pk=order.product_list_id)
+    if not cart.status == Cart.PROCESSED:
+        raise ValidationError("Wrong cart status")
+    lines = list(CartItem.objects.filter(cart=cart).order_by('product_id').values_list('product_id', 'amount'))
+    short = []
+    for product_id, amount in lines:
+        # the stock check and the decrement are one statement, so concurrent payments can't oversell
+        if not Product.objects.filter(pk=product_id, amount_in_stock__gte=amount) \
+                .update(amount_in_stock=F('amount_in_stock') - amount):
+            short.append(product_id)
+    if short:
+        # raising inside the transaction rolls back the decrements that did succeed
+        raise ValidationError({'products': ['Not enough of product %s in stock' % product_id
+                                            for product_id in short]})
+    Cart.objects.filter(pk=cart.pk).update(status=Cart.CLOSED)
+    StockReservation.objects.release(cart.pk)
+    # update() skips the Product signals, so the caches they maintain are refreshed here
+    transaction.on_commit(bump_catalog_version)
+    if Product.objects.filter(pk__in=[product_id for product_id, _ in lines], amount_in_stock__lte=0).exists():
+        transaction.on_commit(invalidate_catalog_facets)
+
+
+def receipt(order):
+    return [
+        {
+            "Message": "Your payment has been processed successfully. Your order has been confirmed",
+            "Order_number": order.id,
+        },
+        {
+            "Order information":
+                {
+                    "customer": {
+                        "name": order.customer.username
+                    },
+                    "product_list":
+                        {
+                            "cart_items": {
+                                order.product_list.cart_items.values().filter(cart=order.product_list)
+                            }
+
+                        },
+                    "shipping_address": model_to_dict(order.shipping_address),
+                    # the receipt is stored on the payment job, so the card is only identified by its last digits
+                    "payment_details": {"card_number": "*" * 12 + order.payment_details.card_number[-4:]}
+                    if order.payment_details_id else None,
+                    "total_price": order.total_price,
+                    "order_status": order.get_order_status_display(),
+                    "created_date": order.created_date
+                }
+        }
+    ]
+
+
+def pay_order(order_id):
+    order = Order.objects.select_related('customer', 'product_list', 'shipping_address', 'payment_details') \
+        .get(pk=order_id)
+    with transaction.atomic():
+        paid_date = timezone.now()
+        # only the payment whose UPDATE marks the order paid takes the stock and records the sale
+        if not Order.objects.filter(pk=order.pk, paid=False).update(order_status=Order.PAID, paid=True,
+                                                                    paid_date=paid_date):
+            raise ValidationError("Order is already paid")
+        decrement_stock(order)
+        result = receipt(order)
+        order.order_status, order.paid, order.paid_date = Order.PAID, True, paid_date
+        record_sale(order)
+    return result
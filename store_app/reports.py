@@ -0,0 +1,133 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import Order, ArchivedOrder, Product, Category, DailySales, DailyProductSales, DailyCategorySales
+
+
+def product_sales(order):
+    # revenue and units per product, from the lines frozen on the order; archived orders always carry theirs
+    lines = order.lines
+    if not lines and isinstance(order, Order):
+        lines = Order.snapshot_lines(order.product_list_id)
+    sales = defaultdict(lambda: [Decimal(0), 0])
+    for line in lines:
+        sales[line['product']][0] += Decimal(line['total'])
+        sales[line['product']][1] += line['amount']
+    return sales
+
+
+def product_categories(product_ids):
+    categories = defaultdict(list)
+    links = Product.category.through.objects.filter(product_id__in=product_ids) \
+        .values_list('product_id', 'category_id')
+    for product_id, category_id in links:
+        categories[product_id].append(category_id)
+    return categories
+
+
+def category_sales(sales, categories):
+    # a product in several categories counts towards each of them
+    totals = defaultdict(lambda: [Decimal(0), 0])
+    for product_id, (revenue, units) in sales.items():
+        for category_id in categories.get(product_id, ()):
+            totals[category_id][0] += revenue
+            totals[category_id][1] += units
+    return totals
+
+
+def add_to_rollup(model, lookup, revenue, units, orders=1):
+    increments = {'revenue': F('revenue') + revenue, 'units': F('units') + units, 'orders': F('orders') + orders}
+    if model.objects.filter(**lookup).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(revenue=revenue, units=units, orders=orders, **lookup)
+    except IntegrityError:
+        # another payment created the row first
+        model.objects.filter(**lookup).update(**increments)
+
+
+def record_sale(order):
+    # Adds one paid order to the rollups; call it in the transaction that marks the order paid
+    day = timezone.localdate(order.paid_date)
+    sales = product_sales(order)
+    add_to_rollup(DailySales, {'date': day}, sum(revenue for revenue, _ in sales.values()),
+                  sum(units for _, units in sales.values()))
+    for product_id, (revenue, units) in sales.items():
+        add_to_rollup(DailyProductSales, {'date': day, 'product_id': product_id}, revenue, units)
+    for category_id, (revenue, units) in category_sales(sales, product_categories(list(sales))).items():
+        add_to_rollup(DailyCategorySales, {'date': day, 'category_id': category_id}, revenue, units)
+
+
+def day_range(start, end):
+    # [start, end] as aware datetimes covering whole local days
+    return (timezone.make_aware(datetime.combine(start, time.min)),
+            timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min)))
+
+
+@transaction.atomic
+def rebuild_rollups(start, end):
+    # Recomputes the rollups for the days start..end from the paid orders in them; returns the number of orders
+    daily = defaultdict(lambda: [Decimal(0), 0, 0])
+    by_product = defaultdict(lambda: [Decimal(0), 0, 0])
+    by_category = defaultdict(lambda: [Decimal(0), 0, 0])
+    sold = []
+    # orders moved out by apply_retention still count towards the days they were paid on
+    for model, fields in ((Order, ('paid_date', 'lines', 'product_list')), (ArchivedOrder, ('paid_date', 'lines'))):
+        orders = model.objects.filter(paid=True, paid_date__range=day_range(start, end)).only(*fields).order_by('id')
+        for order in orders.iterator(chunk_size=1000):
+            sold.append((timezone.localdate(order.paid_date), product_sales(order)))
+    categories = product_categories({product_id for _, sales in sold for product_id in sales})
+    for day, sales in sold:
+        daily[day][2] += 1
+        for product_id, (revenue, units) in sales.items():
+            for totals in (daily[day], by_product[day, product_id]):
+                totals[0] += revenue
+                totals[1] += units
+            by_product[day, product_id][2] += 1
+        for category_id, (revenue, units) in category_sales(sales, categories).items():
+            by_category[day, category_id][0] += revenue
+            by_category[day, category_id][1] += units
+            by_category[day, category_id][2] += 1
+    for model in (DailySales, DailyProductSales, DailyCategorySales):
+        model.objects.filter(date__range=(start, end)).delete()
+    DailySales.objects.bulk_create([DailySales(date=day, revenue=revenue, units=units, orders=count)
+                                    for day, (revenue, units, count) in daily.items()])
+    DailyProductSales.objects.bulk_create([
+        DailyProductSales(date=day, product_id=product_id, revenue=revenue, units=units, orders=count)
+        for (day, product_id), (revenue, units, count) in by_product.items()])
+    DailyCategorySales.objects.bulk_create([
+        DailyCategorySales(date=day, category_id=category_id, revenue=revenue, units=units, orders=count)
+        for (day, category_id), (revenue, units, count) in by_category.items()])
+    return len(sold)
+
+
+REPORT_GROUPS = {
+    'day': (DailySales, 'date'),
+    'product': (DailyProductSales, 'product_id'),
+    'category': (DailyCategorySales, 'category_id'),
+}
+
+
+def sales_report(start, end, group_by='day'):
+    # Reads only the rollup tables: one grouped query for the rows and one sum for the totals
+    model, key = REPORT_GROUPS[group_by]
+    sums = {'revenue': Sum('revenue'), 'units': Sum('units'), 'orders': Sum('orders')}
+    rollups = model.objects.filter(date__range=(start, end))
+    ordering = (key,) if group_by == 'day' else ('-revenue', key)
+    rows = list(rollups.values(key).annotate(**sums).order_by(*ordering))
+    if group_by != 'day':
+        # names come from the live tables; rows for deleted products or categories keep just their id
+        names = dict((Product if group_by == 'product' else Category).objects
+                     .filter(pk__in=[row[key] for row in rows]).values_list('pk', 'name'))
+        for row in rows:
+            row[group_by] = row.pop(key)
+            row['name'] = names.get(row[group_by])
+    totals = DailySales.objects.filter(date__range=(start, end)).aggregate(**sums)
+    return {'start': start, 'end': end, 'group_by': group_by,
+            'totals': {field: value or 0 for field, value in totals.items()}, 'rows': rows}
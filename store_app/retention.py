@@ -0,0 +1,60 @@
+from django.db import transaction
+from django.forms import model_to_dict
+
+from .models import Cart, Order, PaymentDetails, ArchivedOrder
+
+ARCHIVED_STATUSES = (Order.DELIVERED, Order.RECEIVED)
+
+
+def orders_to_archive(before):
+    return Order.objects.filter(order_status__in=ARCHIVED_STATUSES, created_date__lt=before)
+
+
+def abandoned_carts(before):
+    # open carts nobody has touched since `before` and that never became an order
+    return Cart.objects.filter(status=Cart.OPEN, updated_date__lt=before, cart__isnull=True)
+
+
+def expired_payment_details(today):
+    # a card still referenced by an order is kept: deleting it would cascade to the order
+    return PaymentDetails.objects.filter(expiration_date__lt=today, order__isnull=True)
+
+
+def archive(order):
+    address = model_to_dict(order.shipping_address, exclude=['id', 'customer', 'default']) \
+        if order.shipping_address_id else None
+    return ArchivedOrder(order_id=order.id, customer_id=order.customer_id, order_status=order.order_status,
+                         total_price=order.total_price, paid=order.paid, created_date=order.created_date,
+                         paid_date=order.paid_date, lines=order.lines or Order.snapshot_lines(order.product_list_id),
+                         shipping_address=address)
+
+
+def archive_orders(before, chunk_size=500):
+    # Moves old delivered/received orders into ArchivedOrder one chunk per transaction, yielding the chunk sizes.
+    # Deleting the cart takes its order, lines and reservations with it.
+    while True:
+        with transaction.atomic():
+            orders = list(orders_to_archive(before).select_related('shipping_address').order_by('id')[:chunk_size])
+            if not orders:
+                return
+            ArchivedOrder.objects.bulk_create([archive(order) for order in orders])
+            Cart.objects.filter(pk__in=[order.product_list_id for order in orders]).delete()
+        yield len(orders)
+
+
+def purge(queryset, chunk_size):
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return
+        # the conditions are checked again so a cart used since it was selected survives
+        _, deleted = queryset.filter(pk__in=ids).delete()
+        yield deleted.get(queryset.model._meta.label, 0)
+
+
+def purge_abandoned_carts(before, chunk_size=500):
+    return purge(abandoned_carts(before), chunk_size)
+
+
+def purge_expired_payment_details(today, chunk_size=500):
+    return purge(expired_payment_details(today), chunk_size)
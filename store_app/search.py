@@ -0,0 +1,54 @@
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'store_app_product_fts'
+# bm25 column weights for (name, description): a hit in the name outranks one in the description
+FTS_RANK = 'bm25(%s, 10.0, 1.0)' % FTS_TABLE
+
+
+def fts_available():
+    return connection.vendor == 'sqlite'
+
+
+def build_match_query(text):
+    # Every word is quoted so user input can't break the FTS5 query syntax, and prefix-matched
+    terms = ['"%s"*' % term.replace('"', '""') for term in text.split()]
+    return ' '.join(terms)
+
+
+def index_products(products):
+    if not fts_available() or not products:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany("DELETE FROM %s WHERE rowid = %%s" % FTS_TABLE, [(product.id,) for product in products])
+        cursor.executemany("INSERT INTO %s (rowid, name, description) VALUES (%%s, %%s, %%s)" % FTS_TABLE,
+                           [(product.id, product.name, product.description) for product in products])
+
+
+def remove_products(product_ids):
+    if not fts_available() or not product_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany("DELETE FROM %s WHERE rowid = %%s" % FTS_TABLE,
+                           [(product_id,) for product_id in product_ids])
+
+
+def clear_index():
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s" % FTS_TABLE)
+
+
+def search_products(queryset, text):
+    match = build_match_query(text)
+    if not match:
+        return queryset
+    if not fts_available():
+        return queryset.filter(Q(name__icontains=text) | Q(description__icontains=text))
+    table = queryset.model._meta.db_table
+    matched_ids = RawSQL("SELECT rowid FROM %s WHERE %s MATCH %%s" % (FTS_TABLE, FTS_TABLE), (match,))
+    rank = RawSQL("SELECT %s FROM %s WHERE %s MATCH %%s AND rowid = %s.id" % (FTS_RANK, FTS_TABLE, FTS_TABLE, table),
+                  (match,))
+    return queryset.filter(id__in=matched_ids).annotate(search_rank=rank).order_by('search_rank', 'id')
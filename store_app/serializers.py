@@ -1,9 +1,17 @@
+from datetime import timedelta
+
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password
-from rest_framework.generics import get_object_or_404
+from django.core.files.storage import default_storage
+from django.http import Http404
+from django.utils import timezone
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from .models import Category, Product, Cart, CartItem, PaymentDetails, ShippingAddress, Order, Feedback
+from .images import variant_urls
+from .loaders import get_loader, RequestLoader
+from .reports import REPORT_GROUPS
+from .models import Category, Product, Cart, CartItem, PaymentDetails, ShippingAddress, Order, Feedback, Job, \
+    ArchivedOrder
 from rest_framework import serializers
 
 
@@ -51,24 +59,121 @@ class CategorySerializer(serializers.ModelSerializer):
 
 class ProductSerializer(serializers.ModelSerializer):
     image = serializers.ImageField(required=False, use_url=True)
+    image_variants = serializers.SerializerMethodField()
     category = CategorySerializer(many=True)
+    feedback_rate = serializers.FloatField(read_only=True)
+    rating_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Product
+        fields = ['name', 'description', 'price', 'amount_in_stock', 'image', 'image_variants', 'category',
+                  'feedback_rate', 'rating_count']
+
+    def get_image_variants(self, obj):
+        if not obj.image:
+            return None
+        request = self.context.get('request')
+        urls = variant_urls(obj.image.name)
+        if request is not None:
+            urls = {variant: request.build_absolute_uri(url) for variant, url in urls.items()}
+        return urls
+
+
+class ProductRow:
+    # One catalog row read with values(); __slots__ keeps a page of them small and cheap to build
+    __slots__ = ('id', 'name', 'description', 'price', 'amount_in_stock', 'image', 'rating_sum', 'rating_count',
+                 'category')
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, values, category):
+        for field in self.FIELDS:
+            setattr(self, field, values[field])
+        self.category = category
+
+
+class ProductFastSerializer:
+    # Read-only twin of ProductSerializer for GET list/detail. It renders ProductRow objects straight to
+    # dicts and must produce exactly the same JSON as ProductSerializer.
+    price_field = serializers.DecimalField(max_digits=7, decimal_places=2)
+
+    def __init__(self, context=None):
+        self.request = (context or {}).get('request')
+
+    @staticmethod
+    def load_rows(values_rows):
+        product_ids = [values['id'] for values in values_rows]
+        categories = {}
+        links = Product.category.through.objects.filter(product_id__in=product_ids) \
+            .order_by('category_id').values_list('product_id', 'category__name')
+        for product_id, name in links:
+            categories.setdefault(product_id, []).append({'name': name})
+        return [ProductRow(values, categories.get(values['id'], [])) for values in values_rows]
+
+    def absolute_url(self, url):
+        if self.request is not None:
+            return self.request.build_absolute_uri(url)
+        return url
+
+    def to_representation(self, row):
+        image = None
+        image_variants = None
+        if row.image:
+            image = self.absolute_url(default_storage.url(row.image))
+            image_variants = {variant: self.absolute_url(url) for variant, url in variant_urls(row.image).items()}
+        return {
+            'name': row.name,
+            'description': row.description,
+            'price': self.price_field.to_representation(row.price),
+            'amount_in_stock': row.amount_in_stock,
+            'image': image,
+            'image_variants': image_variants,
+            'category': row.category,
+            'feedback_rate': row.rating_sum / row.rating_count if row.rating_count else None,
+            'rating_count': row.rating_count,
+        }
+
+    def serialize(self, values_rows):
+        return [self.to_representation(row) for row in self.load_rows(values_rows)]
+
+
+class ProductImportSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(required=False)
+    description = serializers.CharField(allow_blank=True, required=False, default='')
+    category = serializers.ListField(child=serializers.IntegerField(), required=False)
 
     class Meta:
         model = Product
-        fields = ['name', 'description', 'price', 'amount_in_stock', 'image', 'category']
+        fields = ['id', 'name', 'description', 'price', 'amount_in_stock', 'category']
+
+
+class LoadedProductField(serializers.PrimaryKeyRelatedField):
+    # Resolves the product through the request's identity map, so the view and validate() share one instance
+    def to_internal_value(self, data):
+        request = self.context.get('request')
+        if request is None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return get_loader(request).product(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        except Http404:
+            self.fail('does_not_exist', pk_value=data)
 
 
 class CartItemSerializer(serializers.ModelSerializer):
     price = serializers.DecimalField(max_digits=7, decimal_places=2, read_only=True)
+    product = LoadedProductField(queryset=Product.objects.all())
 
     def validate(self, data):
+        request = self.context.get('request')
+        loader = get_loader(request) if request is not None else RequestLoader()
         if "product" in data:
-            product_id = data["product"].id
+            product = data["product"]
         else:
-            id = self.context.get('id')
-            cart_item = get_object_or_404(CartItem, pk=id)
-            product_id = cart_item.product.id
-        product = get_object_or_404(Product, pk=product_id)
+            cart_item = loader.cart_item(self.context.get('id'))
+            product = loader.product(cart_item.product_id)
         if product.amount_in_stock < data["amount"]:
             raise serializers.ValidationError("You are trying to add more than exists of this product")
         if product.amount_in_stock == 0:
@@ -80,6 +185,34 @@ class CartItemSerializer(serializers.ModelSerializer):
         fields = ['amount', 'product', 'price']
 
 
+class CartOperationSerializer(serializers.Serializer):
+    ADD = 'add'
+    UPDATE = 'update'
+    REMOVE = 'remove'
+    OPERATION_CHOICES = (ADD, UPDATE, REMOVE)
+    op = serializers.ChoiceField(choices=OPERATION_CHOICES)
+    product = serializers.IntegerField(required=False)
+    item = serializers.IntegerField(required=False)
+    amount = serializers.IntegerField(required=False, min_value=1)
+
+    def validate(self, data):
+        required = {self.ADD: ('product', 'amount'), self.UPDATE: ('item', 'amount'), self.REMOVE: ('item',)}
+        missing = [field for field in required[data['op']] if field not in data]
+        if missing:
+            raise serializers.ValidationError("%s needs %s" % (data['op'], ', '.join(missing)))
+        return data
+
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False)
+
+
+class CartSummarySerializer(serializers.Serializer):
+    item_count = serializers.IntegerField()
+    distinct_products = serializers.IntegerField()
+    total_price = serializers.DecimalField(max_digits=7, decimal_places=2)
+
+
 class CartSerializer(serializers.ModelSerializer):
     customer = UserSerializer(read_only=True)
     cart_items = CartItemSerializer(many=True)
@@ -110,28 +243,61 @@ class ShippingAddressSerializer(serializers.ModelSerializer):
 
 class OrderSerializer(serializers.ModelSerializer):
     customer = UserSerializer(read_only=True)
-    product_list = CartSerializer(read_only=True)
+    product_list = serializers.PrimaryKeyRelatedField(read_only=True)
+    lines = serializers.JSONField(read_only=True)
     order_status = serializers.CharField(source='get_order_status_display', read_only=True)
     total_price = serializers.DecimalField(max_digits=7, decimal_places=2, read_only=True, source='order.total_price')
     paid = serializers.BooleanField(read_only=True, source='order.paid')
 
     class Meta:
         model = Order
-        fields = ['customer', 'product_list', 'total_price', 'shipping_address', 'payment_details',
+        fields = ['customer', 'product_list', 'lines', 'total_price', 'shipping_address', 'payment_details',
                   'order_status', 'paid', 'created_date']
 
 
 class OrderAdminSerializer(serializers.ModelSerializer):
-    product_list = CartSerializer()
+    product_list = serializers.PrimaryKeyRelatedField(read_only=True)
+    lines = serializers.JSONField(read_only=True)
     customer = UserSerializer()
     order_status = serializers.CharField(source='get_order_status_display')
     created_date = serializers.DateTimeField(format="%m/%d/%Y %H:%M")
 
     class Meta:
         model = Order
-        fields = ['customer', 'product_list', 'total_price', 'shipping_address', 'payment_details',
+        fields = ['customer', 'product_list', 'lines', 'total_price', 'shipping_address', 'payment_details',
                   'order_status', 'paid', 'created_date']
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        # Mirrors the fields above: the line items are a snapshot stored on the order, so only the customer is
+        # joined. The cart, addresses and payment details render as ids read off the order row.
+        return queryset.select_related('customer')
+
+
+class ArchivedOrderSerializer(serializers.ModelSerializer):
+    order_status = serializers.CharField(source='get_order_status_display', read_only=True)
+
+    class Meta:
+        model = ArchivedOrder
+        fields = ['order_id', 'customer', 'lines', 'total_price', 'shipping_address', 'order_status', 'paid',
+                  'created_date', 'paid_date', 'archived_date']
+        read_only_fields = fields
+
+
+class OrderStatusTransitionSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    order_status = serializers.ChoiceField(choices=Order.ORDER_STATUS_CHOICES)
+
+
+class OrderBulkStatusSerializer(serializers.Serializer):
+    transitions = OrderStatusTransitionSerializer(many=True, allow_empty=False, max_length=1000)
+
+    def validate_transitions(self, transitions):
+        ids = [transition['id'] for transition in transitions]
+        if len(ids) != len(set(ids)):
+            raise serializers.ValidationError("Each order can only appear once")
+        return transitions
+
 
 class FeedbackSerializer(serializers.ModelSerializer):
     customer = UserSerializer(read_only=True)
@@ -142,6 +308,67 @@ class FeedbackSerializer(serializers.ModelSerializer):
         fields = ['product', 'customer', 'text', 'rate']
 
 
+class OrderPaymentSerializer(serializers.Serializer):
+    # the 202 answer to a payment request; the body of the request itself is empty
+    job = serializers.IntegerField(read_only=True)
+    status = serializers.CharField(read_only=True)
+    status_url = serializers.CharField(read_only=True)
+
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = ['id', 'kind', 'status', 'result', 'attempts', 'created_date', 'started_at', 'finished_at']
+
+
+class SalesReportQuerySerializer(serializers.Serializer):
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    group_by = serializers.ChoiceField(choices=list(REPORT_GROUPS), default='day')
+
+    def validate(self, data):
+        # the last 30 days unless asked otherwise
+        data.setdefault('end', timezone.localdate())
+        data.setdefault('start', data['end'] - timedelta(days=29))
+        if data['start'] > data['end']:
+            raise serializers.ValidationError("start must not be after end")
+        return data
+
+
+class OrderExportQuerySerializer(serializers.Serializer):
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    order_status = serializers.ChoiceField(choices=Order.ORDER_STATUS_CHOICES, required=False)
+    # resume an interrupted export from the last order id it wrote
+    after_id = serializers.IntegerField(min_value=0, default=0)
+
+    def validate(self, data):
+        if 'start' in data and 'end' in data and data['start'] > data['end']:
+            raise serializers.ValidationError("start must not be after end")
+        return data
+
+
+class SalesTotalsSerializer(serializers.Serializer):
+    revenue = serializers.DecimalField(max_digits=15, decimal_places=2)
+    units = serializers.IntegerField()
+    orders = serializers.IntegerField()
+
+
+class SalesRowSerializer(SalesTotalsSerializer):
+    date = serializers.DateField(required=False)
+    product = serializers.IntegerField(required=False)
+    category = serializers.IntegerField(required=False)
+    name = serializers.CharField(required=False, allow_null=True)
+
+
+class SalesReportSerializer(serializers.Serializer):
+    start = serializers.DateField()
+    end = serializers.DateField()
+    group_by = serializers.CharField()
+    totals = SalesTotalsSerializer()
+    rows = SalesRowSerializer(many=True)
+
+
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user):
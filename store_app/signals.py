@@ -0,0 +1,100 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from . import facets, images, search
+from .cache import bump_catalog_version
+from .models import Product, Category, Feedback
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_products([instance])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove_products([instance.id])
+
+
+@receiver(post_save, sender=Product)
+def schedule_image_variants(sender, instance, **kwargs):
+    if instance.image:
+        image_name = instance.image.name
+        transaction.on_commit(lambda: images.schedule_variants(image_name))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Feedback)
+@receiver(post_delete, sender=Feedback)
+@receiver(m2m_changed, sender=Product.category.through)
+def invalidate_catalog_cache(sender, **kwargs):
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_facets(sender, instance, **kwargs):
+    if instance.pk and facets.catalog_facets_cached():
+        instance._facet_previous = Product.objects.filter(pk=instance.pk).values('price', 'amount_in_stock').first()
+
+
+@receiver(post_save, sender=Product)
+def update_product_facets(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_facet_previous', None)
+    instance._facet_previous = None
+    deltas = [facets.product_delta(instance.price, instance.amount_in_stock, 1)]
+    if previous:
+        deltas.append(facets.product_delta(previous['price'], previous['amount_in_stock'], -1))
+    elif not created:
+        return
+    for delta in deltas:
+        transaction.on_commit(lambda delta=delta: facets.apply_delta(delta))
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_categories(sender, instance, **kwargs):
+    if facets.catalog_facets_cached():
+        instance._facet_categories = list(instance.category.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_facets(sender, instance, **kwargs):
+    delta = facets.product_delta(instance.price, instance.amount_in_stock, -1)
+    delta['category'] = facets.category_delta(getattr(instance, '_facet_categories', []), -1)['category']
+    transaction.on_commit(lambda: facets.apply_delta(delta))
+
+
+@receiver(m2m_changed, sender=Product.category.through)
+def update_category_facets(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance._facet_cleared = {instance.id: instance.product.count()}
+        else:
+            instance._facet_cleared = {category_id: 1 for category_id in instance.category.values_list('id', flat=True)}
+        return
+    if action == 'post_clear':
+        delta = {'category': {category_id: -count
+                              for category_id, count in getattr(instance, '_facet_cleared', {}).items()}}
+    elif action in ('post_add', 'post_remove') and pk_set:
+        sign = 1 if action == 'post_add' else -1
+        if reverse:
+            delta = {'category': {instance.id: sign * len(pk_set)}}
+        else:
+            delta = facets.category_delta(pk_set, sign)
+    else:
+        return
+    transaction.on_commit(lambda: facets.apply_delta(delta))
+
+
+@receiver(post_save, sender=Category)
+def rename_category_facet(sender, instance, **kwargs):
+    transaction.on_commit(lambda: facets.rename_category(instance))
+
+
+@receiver(post_delete, sender=Category)
+def remove_category_facet(sender, instance, **kwargs):
+    category_id = instance.id
+    transaction.on_commit(lambda: facets.remove_category(category_id))
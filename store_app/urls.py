@@ -5,19 +5,28 @@ from .views_api import CategoryCreateList, CategoryUpdateDetailRemove, ProductCr
     CartItemCreateList, CartItemUpdateDetailRemove, PaymentDetailsCreateList, \
     OrderCreateList, OrderUpdateDetailRemove, OrderChangeStatus, OrderList, PaymentDetailsUpdateDetailRemove, \
     ShippingAddressCreateList, ShippingAddressUpdateDetailRemove, FeedbackCreateList, FeedbackUpdateDetailRemove, \
-    OrderReceiving, OrderPayment
+    OrderReceiving, OrderPayment, ProductFacets, ProductImport, ProductExport, CartBatch, CartSummary, \
+    JobDetail, OrderBulkStatus, SalesReport, ArchivedOrderList, ArchivedOrderDetail, \
+    OrderExport
 from django.urls import path
 
 urlpatterns = [
     path('category/', CategoryCreateList.as_view(), name="category_list_create_api"),
     path('category/<int:pk>/', CategoryUpdateDetailRemove.as_view(), name="category_update_detail_remove_api"),
     path('product/', ProductCreateList.as_view(), name="product_list_create_api"),
+    path('product/facets/', ProductFacets.as_view(), name="product_facets_api"),
+    path('product/import/', ProductImport.as_view(), name="product_import_api"),
+    path('product/export/', ProductExport.as_view(), name="product_export_api"),
     path('product/<int:pk>/', ProductUpdateDetailRemove.as_view(), name="product_update_detail_remove_api"),
     path('product/<int:pk>/feedback/', FeedbackCreateList.as_view(), name="feedback_list_create_api"),
     path('product/<int:pk>/feedback/<int:feedback_pk>/', FeedbackUpdateDetailRemove.as_view(),
          name="feedback_update_detail_remove_api"),
     path('orders/', OrderList.as_view(), name="order_list_api"),
+    path('orders/status/', OrderBulkStatus.as_view(), name="order_bulk_status_api"),
+    path('orders/export/', OrderExport.as_view(), name="order_export_api"),
     path('cart/', CartItemCreateList.as_view(), name="item_create_list_remove_api"),
+    path('cart/batch/', CartBatch.as_view(), name="cart_batch_api"),
+    path('cart/summary/', CartSummary.as_view(), name="cart_summary_api"),
     path('cart/items/<int:pk>/', CartItemUpdateDetailRemove.as_view(), name="item_update_detail_remove_api"),
     path('order/', OrderCreateList.as_view(), name="order_list_create_api"),
     path('order/<int:pk>/', OrderUpdateDetailRemove.as_view(), name="order_update_detail_remove_api"),
@@ -26,6 +35,10 @@ urlpatterns = [
     path('order/<int:pk>/approve_receipt/', OrderReceiving.as_view(),
          name="order_receiving_api"),
     path('order/<int:pk>/payment/', OrderPayment.as_view(), name="order_payment_api"),
+    path('order/archive/', ArchivedOrderList.as_view(), name="archived_order_list_api"),
+    path('order/archive/<int:order_id>/', ArchivedOrderDetail.as_view(), name="archived_order_detail_api"),
+    path('jobs/<int:pk>/', JobDetail.as_view(), name="job_detail_api"),
+    path('reports/sales/', SalesReport.as_view(), name="sales_report_api"),
     path('payment-details/', PaymentDetailsCreateList.as_view(), name="payment_details_list_create_api"),
     path('payment-details/<int:pk>/', PaymentDetailsUpdateDetailRemove.as_view(),
          name="payment_details_update_detail_remove_api"),
@@ -1,22 +1,43 @@
+import hashlib
+import io
+import json
+import os
 from decimal import Decimal
 
 from django.contrib.auth.models import User
 from django.core import serializers
-from django.db.models import Prefetch, Q, Avg, Sum, Count
-from django.forms import model_to_dict
+from django.db import transaction
+from django.db.models import Prefetch, Q, Sum, Count, F
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import parse_etags
 from django_filters import rest_framework as filters
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import get_object_or_404
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
+from .cache import CatalogCacheMixin
+from .facets import get_facets, get_catalog_facets
+from .exporters import export_products, export_orders, EXPORT_FORMATS, CONTENT_TYPES
+from .idempotency import IdempotencyMixin
+from .jobs import enqueue
+from .importers import ProductImporter, read_rows, IMPORT_FORMATS
+from .loaders import get_loader
 from .filters import ProductFilter, OrderFilter, CategoryFilter
-from .models import Category, Product, Cart, CartItem, PaymentDetails, ShippingAddress, Order, Feedback
+from .models import Category, Product, Cart, CartItem, PaymentDetails, ShippingAddress, Order, Feedback, \
+    StockReservation, Job, ArchivedOrder
+from .pagination import CursorPaginationMixin
 from .permissions import IsAdminPermission, IsOwnerOrAdminPermission
+from .reports import day_range, sales_report
+from .search import search_products
 from .serializers import CategorySerializer, ProductSerializer, CartSerializer, CartItemSerializer, \
     PaymentDetailsSerializer, ShippingAddressSerializer, OrderSerializer, FeedbackSerializer, UserSerializer, \
-    OrderAdminSerializer
+    OrderAdminSerializer, ProductFastSerializer, ProductRow, CartBatchSerializer, CartOperationSerializer, \
+    CartSummarySerializer, JobSerializer, OrderBulkStatusSerializer, SalesReportSerializer, \
+    SalesReportQuerySerializer, ArchivedOrderSerializer, OrderExportQuerySerializer, OrderPaymentSerializer
 from rest_framework import generics, status
 
 IN_PROCESS = 1
@@ -27,7 +48,26 @@ DELIVERED = 5
 RECEIVED = 6
 
 
-class CategoryCreateList(generics.ListCreateAPIView):
+class ProductFastReadMixin:
+    # GET list/detail render from values() rows through ProductFastSerializer instead of model instances
+
+    def get_values_queryset(self):
+        return self.filter_queryset(self.get_queryset()).prefetch_related(None).values(*ProductRow.FIELDS)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_values_queryset()
+        page = self.paginate_queryset(queryset)
+        serializer = ProductFastSerializer(self.get_serializer_context())
+        if page is not None:
+            return self.get_paginated_response(serializer.serialize(page))
+        return Response(serializer.serialize(queryset))
+
+    def retrieve(self, request, *args, **kwargs):
+        values = get_object_or_404(self.get_values_queryset(), pk=self.kwargs.get('pk'))
+        return Response(ProductFastSerializer(self.get_serializer_context()).serialize([values])[0])
+
+
+class CategoryCreateList(CatalogCacheMixin, CursorPaginationMixin, generics.ListCreateAPIView):
     permission_classes = [IsAdminPermission]
     serializer_class = CategorySerializer
     pagination_class = PageNumberPagination
@@ -48,7 +88,7 @@ class SignUp(generics.CreateAPIView):
     serializer_class = UserSerializer
 
 
-class ProductCreateList(generics.ListCreateAPIView):
+class ProductCreateList(CatalogCacheMixin, ProductFastReadMixin, CursorPaginationMixin, generics.ListCreateAPIView):
     permission_classes = [IsAdminPermission]
     serializer_class = ProductSerializer
     pagination_class = PageNumberPagination
@@ -56,23 +96,102 @@ class ProductCreateList(generics.ListCreateAPIView):
     filterset_class = ProductFilter
 
     def get_queryset(self):
+        # rating_sum/rating_count are kept on the product row, so the feedback table is not joined here
         products = Product.objects.prefetch_related('category')
-        products_with_rating = (products.prefetch_related('feedback').annotate(feedback_rate=Avg('feedback__rate')))
-        return products_with_rating
+        text = self.request.query_params.get('q')
+        if text:
+            products = search_products(products, text)
+        return products
+
+    def use_cursor_pagination(self):
+        # search results are ordered by rank, which a cursor on id can't page through, so they keep page numbers
+        return not self.request.query_params.get('q') and super().use_cursor_pagination()
+
+
+class ProductFacets(generics.GenericAPIView):
+    permission_classes = [IsAdminPermission]
+    filter_backends = (filters.DjangoFilterBackend,)
+    filterset_class = ProductFilter
+
+    def get_queryset(self):
+        products = Product.objects.all()
+        text = self.request.query_params.get('q')
+        if text:
+            products = search_products(products, text)
+        return products
+
+    def get(self, request, *args, **kwargs):
+        if not request.query_params:
+            return Response(get_catalog_facets())
+        return Response(get_facets(self.filter_queryset(self.get_queryset())))
+
 
+class ProductImport(generics.GenericAPIView):
+    permission_classes = [IsAdminUser]
+    parser_classes = [MultiPartParser]
 
-class OrderList(generics.ListAPIView):
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'Message': 'Upload the catalog as "file"'}, status=status.HTTP_400_BAD_REQUEST)
+        file_format = request.data.get('file_format') or os.path.splitext(upload.name)[1].lstrip('.').lower()
+        if file_format not in IMPORT_FORMATS:
+            return Response({'Message': 'file_format must be one of %s' % ', '.join(IMPORT_FORMATS)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        stream = io.TextIOWrapper(upload.file, encoding='utf-8', newline='')
+        report = ProductImporter().run(read_rows(stream, file_format))
+        return Response(report, status=status.HTTP_200_OK)
+
+
+class ProductExport(generics.GenericAPIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        file_format = request.query_params.get('file_format', 'ndjson')
+        if file_format not in EXPORT_FORMATS:
+            return Response({'Message': 'file_format must be one of %s' % ', '.join(EXPORT_FORMATS)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        response = StreamingHttpResponse(export_products(file_format), content_type=CONTENT_TYPES[file_format])
+        response['Content-Disposition'] = 'attachment; filename="products.%s"' % file_format
+        return response
+
+
+class OrderList(CursorPaginationMixin, generics.ListAPIView):
     permission_classes = [IsAdminUser]
     serializer_class = OrderAdminSerializer
     pagination_class = PageNumberPagination
+    cursor_ordering = ('-created_date', 'id')
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_class = OrderFilter
-    queryset = Order.objects.prefetch_related('product_list').select_related('customer').prefetch_related(
-        'shipping_address') \
-        .prefetch_related('payment_details').all()
+    queryset = OrderAdminSerializer.setup_eager_loading(Order.objects.all())
+
 
+class OrderExport(generics.GenericAPIView):
+    # Accounting exports: every matching order with its lines, streamed in id order. A download cut short can
+    # be resumed with ?after_id=<last id written>
+    permission_classes = [IsAdminUser]
 
-class ProductUpdateDetailRemove(generics.RetrieveUpdateDestroyAPIView):
+    def get(self, request, *args, **kwargs):
+        file_format = request.query_params.get('file_format', 'ndjson')
+        if file_format not in EXPORT_FORMATS:
+            return Response({'Message': 'file_format must be one of %s' % ', '.join(EXPORT_FORMATS)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        query = OrderExportQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        orders = Order.objects.filter(id__gt=params['after_id'])
+        if 'start' in params:
+            orders = orders.filter(created_date__gte=day_range(params['start'], params['start'])[0])
+        if 'end' in params:
+            orders = orders.filter(created_date__lt=day_range(params['end'], params['end'])[1])
+        if 'order_status' in params:
+            orders = orders.filter(order_status=params['order_status'])
+        response = StreamingHttpResponse(export_orders(file_format, orders), content_type=CONTENT_TYPES[file_format])
+        response['Content-Disposition'] = 'attachment; filename="orders.%s"' % file_format
+        return response
+
+
+class ProductUpdateDetailRemove(CatalogCacheMixin, ProductFastReadMixin, generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAdminPermission]
     serializer_class = ProductSerializer
     queryset = Product.objects.prefetch_related('category') \
@@ -102,23 +221,34 @@ class CartItemCreateList(generics.ListCreateAPIView):
 
     def create(self, request, *args, **kwargs):
         data = request.data
-        product = get_object_or_404(Product, pk=data["product"])
+        product = get_loader(request).product(data["product"])
         price = data["amount"] * product.price
         serializer = self.get_serializer(data=data)
         serializer.is_valid(raise_exception=True)
-        cart = Cart.objects.filter(customer=self.request.user).filter(Q(status=Cart.OPEN) |
-                                                                      Q(status=Cart.PROCESSED))
-        if not cart:
-            # create a new Cart with the new data from response
-            cart = Cart.objects.create(customer=self.request.user)
-        else:
-            cart = cart[0]
-        cart.total_price += price
-        cart.save()
-        # perform_create method
-        serializer.save(cart=cart, price=price)
+        with transaction.atomic():
+            # a processed cart already has an order with its lines frozen, so new lines go to an open cart
+            cart = Cart.objects.select_for_update().filter(customer=self.request.user, status=Cart.OPEN).first()
+            if cart is None:
+                # create a new Cart with the new data from response
+                cart = Cart.objects.create(customer=self.request.user)
+            item = CartItem.objects.select_for_update().filter(cart=cart, product=product).first()
+            line_amount = data["amount"] + (item.amount if item is not None else 0)
+            if not StockReservation.objects.hold(cart.pk, product.pk, line_amount):
+                raise ValidationError("You are trying to add more than exists of this product")
+            if item is None:
+                serializer.save(cart=cart, price=price)
+                Cart.change_totals(cart.pk, price, data["amount"], 1)
+                response_status = status.HTTP_201_CREATED
+            else:
+                # the product is already in the cart, so the existing line grows instead of adding a new one
+                CartItem.objects.filter(pk=item.pk).update(amount=F('amount') + data["amount"],
+                                                           price=F('price') + price)
+                Cart.change_totals(cart.pk, price, data["amount"])
+                item.refresh_from_db(fields=['amount', 'price'])
+                serializer.instance = item
+                response_status = status.HTTP_200_OK
         headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+        return Response(serializer.data, status=response_status, headers=headers)
 
 
 class CartItemUpdateDetailRemove(generics.RetrieveUpdateDestroyAPIView):
@@ -127,42 +257,154 @@ class CartItemUpdateDetailRemove(generics.RetrieveUpdateDestroyAPIView):
     pagination_class = PageNumberPagination
 
     def get_queryset(self):
-        return CartItem.objects.filter(cart__customer=self.request.user, cart__status=Cart.OPEN)
+        items = CartItem.objects.filter(cart__customer=self.request.user, cart__status=Cart.OPEN) \
+            .select_related('product')
+        if self.request.method in ('PUT', 'PATCH', 'DELETE'):
+            # writes run get_object() inside their transaction, so the line is read and locked in one query
+            items = items.select_for_update(of=('self',))
+        return items
 
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop('partial', False)
-        instance = self.get_object()
-        serializer = self.get_serializer(instance, data=request.data, partial=partial, context={'id': instance.id})
-        serializer.is_valid(raise_exception=True)
-        if "amount" in request.data:
-            instance.cart.total_price -= instance.price
-            request.data["price"] = request.data["amount"] * instance.product.price
-            instance.cart.total_price += request.data["price"]
-            instance.price = request.data["amount"] * instance.product.price
-            instance.cart.save()
-            instance.save()
-        serializer.save()
-        if getattr(instance, '_prefetched_objects_cache', None):
-            instance._prefetched_objects_cache = {}
+        with transaction.atomic():
+            item = get_loader(request).add_cart_item(self.get_object())
+            serializer = self.get_serializer(item, data=request.data, partial=partial,
+                                             context={**self.get_serializer_context(), 'id': item.id})
+            serializer.is_valid(raise_exception=True)
+            old_product_id, old_amount = item.product_id, item.amount
+            for field, value in serializer.validated_data.items():
+                setattr(item, field, value)
+            if item.product_id != old_product_id and CartItem.objects.filter(
+                    cart_id=item.cart_id, product_id=item.product_id).exclude(pk=item.pk).exists():
+                # one line per product: the other line has to be changed instead
+                raise ValidationError({'product': ["Product %s is already in the cart" % item.product_id]})
+            if not StockReservation.objects.hold(item.cart_id, item.product_id, item.amount):
+                raise ValidationError("You are trying to add more than exists of this product")
+            if item.product_id != old_product_id:
+                StockReservation.objects.release(item.cart_id, [old_product_id])
+            price = item.amount * item.product.price
+            Cart.change_totals(item.cart_id, price - item.price, item.amount - old_amount)
+            item.price = price
+            item.save(update_fields=list(serializer.validated_data) + ['price'])
         return Response(serializer.data)
 
     def destroy(self, request, *args, **kwargs):
-        instance = self.get_object()
-        cart = instance.cart
-        cart.total_price -= instance.price
-        cart.save()
-        self.perform_destroy(instance)
-
+        with transaction.atomic():
+            item = self.get_object()
+            Cart.change_totals(item.cart_id, -item.price, -item.amount, -1)
+            StockReservation.objects.release(item.cart_id, [item.product_id])
+            item.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class OrderCreateList(generics.ListCreateAPIView):
+class CartBatch(generics.GenericAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = CartBatchSerializer
+
+    def apply_operations(self, cart, operations):
+        # Everything is checked in memory first, so a failing operation leaves the cart untouched
+        item_ids = {operation['item'] for operation in operations if 'item' in operation}
+        product_ids = {operation['product'] for operation in operations if 'product' in operation}
+        items = CartItem.objects.select_for_update().filter(cart=cart) \
+            .filter(Q(id__in=item_ids) | Q(product_id__in=product_ids)).in_bulk()
+        products = Product.objects.in_bulk(product_ids | {item.product_id for item in items.values()})
+        original_prices = {item_id: item.price for item_id, item in items.items()}
+        original_amounts = {item_id: item.amount for item_id, item in items.items()}
+        # one line per product: adding a product that is already in the cart increases that line
+        lines = {item.product_id: item for item in items.values()}
+        new_items, updated, removed, errors = [], {}, set(), []
+        line_index = {}
+        for index, operation in enumerate(operations):
+            item_id = operation.get('item')
+            if operation['op'] == CartOperationSerializer.ADD:
+                product = products.get(operation['product'])
+                if product is None:
+                    errors.append({'index': index, 'detail': 'Product %s not found' % operation['product']})
+                    continue
+                line = lines.get(product.id)
+                if line is None:
+                    line = lines[product.id] = CartItem(cart=cart, product=product, amount=0)
+                    new_items.append(line)
+                elif line.id is not None:
+                    updated[line.id] = line
+                line.amount += operation['amount']
+            elif item_id not in items or item_id in removed:
+                errors.append({'index': index, 'detail': 'Item %s is not in your cart' % item_id})
+                continue
+            elif operation['op'] == CartOperationSerializer.UPDATE:
+                line = updated[item_id] = items[item_id]
+                line.amount = operation['amount']
+            else:
+                removed.add(item_id)
+                updated.pop(item_id, None)
+                lines.pop(items[item_id].product_id, None)
+                continue
+            product = products[line.product_id]
+            line_index[product.id] = index
+            if product.amount_in_stock == 0:
+                errors.append({'index': index, 'detail': 'This product: %s is out of stock' % product.name})
+            elif product.amount_in_stock < line.amount:
+                errors.append({'index': index, 'detail': 'You are trying to add more than exists of this product'})
+            line.price = line.amount * product.price
+        if errors:
+            raise ValidationError({'operations': errors})
+        short = StockReservation.objects.hold_many(cart.pk, {product_id: line.amount
+                                                             for product_id, line in lines.items()})
+        if short:
+            raise ValidationError({'operations': [
+                {'index': line_index[product_id], 'detail': 'You are trying to add more than exists of this product'}
+                for product_id in short]})
+        StockReservation.objects.release(cart.pk, {items[item_id].product_id for item_id in removed} - set(lines))
+        CartItem.objects.filter(id__in=removed).delete()
+        CartItem.objects.bulk_update(updated.values(), ['amount', 'price'])
+        CartItem.objects.bulk_create(new_items)
+        total_change = sum(line.price for line in new_items) \
+            + sum(line.price - original_prices[item_id] for item_id, line in updated.items()) \
+            - sum(original_prices[item_id] for item_id in removed)
+        items_change = sum(line.amount for line in new_items) \
+            + sum(line.amount - original_amounts[item_id] for item_id, line in updated.items()) \
+            - sum(original_amounts[item_id] for item_id in removed)
+        Cart.change_totals(cart.pk, total_change, items_change, len(new_items) - len(removed))
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            # as in CartItemCreateList.create, only an open cart takes changes
+            cart = Cart.objects.select_for_update().filter(customer=self.request.user, status=Cart.OPEN).first()
+            if cart is None:
+                cart = Cart.objects.create(customer=self.request.user)
+            self.apply_operations(cart, serializer.validated_data['operations'])
+        cart = Cart.objects.select_related('customer').prefetch_related('cart_items').get(pk=cart.pk)
+        return Response(CartSerializer(cart, context=self.get_serializer_context()).data)
+
+
+class CartSummary(generics.GenericAPIView):
+    # Badge data for polling clients: one indexed read of the cart's counter columns, 304 when unchanged
+    permission_classes = [IsAuthenticated]
+    serializer_class = CartSummarySerializer
+
+    def get(self, request, *args, **kwargs):
+        summary = Cart.objects.filter(customer=self.request.user, status__in=[Cart.OPEN, Cart.PROCESSED]) \
+            .order_by('id').values('item_count', 'distinct_products', 'total_price').first()
+        if summary is None:
+            summary = {'item_count': 0, 'distinct_products': 0, 'total_price': Decimal('0')}
+        data = self.get_serializer(summary).data
+        etag = '"%s"' % hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(data, headers=headers)
+
+
+class OrderCreateList(IdempotencyMixin, CursorPaginationMixin, generics.ListCreateAPIView):
     permission_classes = [IsOwnerOrAdminPermission]
     serializer_class = OrderSerializer
     pagination_class = PageNumberPagination
+    cursor_ordering = ('-created_date', 'id')
 
     def get_queryset(self):
-        return Order.objects.filter(customer=self.request.user).order_by('-created_date')
+        return Order.objects.filter(customer=self.request.user).select_related('customer').order_by('-created_date')
 
     def total_price_calculation(self, cart):
         p = CartItem.objects.filter(cart=cart).aggregate(sum=Sum('price'))
@@ -197,7 +439,8 @@ class OrderCreateList(generics.ListCreateAPIView):
         tmp_status, payment_details, shipping_address = self.calculate_status_for_new_order()
         serializer.save(product_list=cart, customer=self.request.user,
                         order_status=tmp_status, payment_details=payment_details,
-                        shipping_address=shipping_address, total_price=total_price)
+                        shipping_address=shipping_address, total_price=total_price,
+                        lines=Order.snapshot_lines(cart.id))
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
@@ -244,7 +487,10 @@ class OrderUpdateDetailRemove(generics.RetrieveUpdateDestroyAPIView):
         return Response(serializer.data)
 
     def get_queryset(self):
-        return Order.objects.filter(id=self.kwargs.get('pk'))
+        queryset = Order.objects.filter(id=self.kwargs.get('pk'))
+        if self.request.user.is_staff:
+            queryset = OrderAdminSerializer.setup_eager_loading(queryset)
+        return queryset
 
 
 class OrderChangeStatus(generics.UpdateAPIView):
@@ -253,6 +499,48 @@ class OrderChangeStatus(generics.UpdateAPIView):
     queryset = Order.objects.all()
 
 
+class OrderBulkStatus(generics.GenericAPIView):
+    # Moves many orders at once: one UPDATE per target status, answered with one short row per order
+    permission_classes = [IsAdminUser]
+    serializer_class = OrderBulkStatusSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        transitions = {transition['id']: transition['order_status']
+                       for transition in serializer.validated_data['transitions']}
+        results, targets = {}, {}
+        with transaction.atomic():
+            current = dict(Order.objects.select_for_update().filter(id__in=transitions)
+                           .values_list('id', 'order_status'))
+            for order_id, target in transitions.items():
+                if order_id not in current:
+                    results[order_id] = {'id': order_id, 'result': 'not_found'}
+                elif current[order_id] == target:
+                    results[order_id] = {'id': order_id, 'order_status': target, 'result': 'unchanged'}
+                elif current[order_id] not in Order.ALLOWED_TRANSITIONS.get(target, ()):
+                    results[order_id] = {'id': order_id, 'order_status': current[order_id], 'result': 'not_allowed'}
+                else:
+                    targets.setdefault(target, []).append(order_id)
+            updated = 0
+            for target, order_ids in targets.items():
+                # the source filter repeats the check in SQL for backends where select_for_update is a no-op
+                Order.objects.filter(id__in=order_ids, order_status__in=Order.ALLOWED_TRANSITIONS[target]) \
+                    .update(order_status=target)
+                # read back inside the transaction, so the results only claim the rows the UPDATE really moved
+                statuses = dict(Order.objects.filter(id__in=order_ids).values_list('id', 'order_status'))
+                for order_id in order_ids:
+                    if statuses.get(order_id) == target:
+                        updated += 1
+                        results[order_id] = {'id': order_id, 'order_status': target, 'result': 'updated'}
+                    elif order_id in statuses:
+                        results[order_id] = {'id': order_id, 'order_status': statuses[order_id],
+                                             'result': 'not_allowed'}
+                    else:
+                        results[order_id] = {'id': order_id, 'result': 'not_found'}
+        return Response({'updated': updated, 'results': [results[order_id] for order_id in transitions]})
+
+
 class OrderReceiving(generics.UpdateAPIView):
     permission_classes = [IsOwnerOrAdminPermission]
     serializer_class = OrderAdminSerializer
@@ -271,6 +559,17 @@ class OrderReceiving(generics.UpdateAPIView):
         return Response(serializer.data)
 
 
+class SalesReport(generics.GenericAPIView):
+    # Finance dashboards: revenue, units and orders per day, product or category, read from the daily rollups
+    permission_classes = [IsAdminUser]
+    serializer_class = SalesReportSerializer
+
+    def get(self, request, *args, **kwargs):
+        query = SalesReportQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        return Response(self.get_serializer(sales_report(**query.validated_data)).data)
+
+
 class PaymentDetailsCreateList(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = PaymentDetailsSerializer
@@ -391,7 +690,7 @@ class ShippingAddressUpdateDetailRemove(generics.RetrieveUpdateDestroyAPIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class FeedbackCreateList(generics.ListCreateAPIView):
+class FeedbackCreateList(CursorPaginationMixin, generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = FeedbackSerializer
 
@@ -400,7 +699,15 @@ class FeedbackCreateList(generics.ListCreateAPIView):
 
     def perform_create(self, serializer):
         product = get_object_or_404(Product, pk=self.kwargs.get('pk'))
-        serializer.save(customer=self.request.user, product=product)
+        with transaction.atomic():
+            feedback = serializer.save(customer=self.request.user, product=product)
+            Product.change_rating(product.id, new_rate=feedback.rate)
+
+    def bought_in_archived_order(self):
+        # apply_retention deletes the carts of archived orders, so those purchases are only in the frozen lines
+        product_id = int(self.kwargs.get('pk'))
+        archived = ArchivedOrder.objects.filter(customer=self.request.user, paid=True).values_list('lines', flat=True)
+        return any(line['product'] == product_id for lines in archived.iterator() for line in lines)
 
     def check_if_paid_for_product(self, serializer, data):
         paid_orders = Order.objects.filter(customer=self.request.user, paid=True)
@@ -411,6 +718,10 @@ class FeedbackCreateList(generics.ListCreateAPIView):
                 self.perform_create(serializer)
                 headers = self.get_success_headers(serializer.data)
                 return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+        if self.bought_in_archived_order():
+            self.perform_create(serializer)
+            headers = self.get_success_headers(serializer.data)
+            return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
         headers = self.get_success_headers(serializer.data)
         return Response({'Message': 'You cannot leave a feedback for this product, first purchase it please'},
                         status=status.HTTP_400_BAD_REQUEST, headers=headers)
@@ -432,63 +743,66 @@ class FeedbackUpdateDetailRemove(generics.RetrieveUpdateDestroyAPIView):
         self.check_object_permissions(self.request, obj)
         return obj
 
+    def perform_update(self, serializer):
+        old_rate = serializer.instance.rate
+        with transaction.atomic():
+            feedback = serializer.save()
+            Product.change_rating(feedback.product_id, old_rate=old_rate, new_rate=feedback.rate)
 
-class OrderPayment(generics.CreateAPIView):
-    permission_classes = [IsOwnerOrAdminPermission]
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            Product.change_rating(instance.product_id, old_rate=instance.rate)
+            instance.delete()
 
-    def get_serializer_class(self):
-        return CartItemSerializer
+
+class OrderPayment(IdempotencyMixin, generics.CreateAPIView):
+    permission_classes = [IsOwnerOrAdminPermission]
+    serializer_class = OrderPaymentSerializer
 
     def get_queryset(self):
-        return Order.objects.filter(id=self.kwargs.get('pk'))
+        return Order.objects.filter(id=self.kwargs.get('pk')).select_related('product_list')
 
     # .prefetch_related('product_list').prefetch_related(
     #             'customer').prefetch_related('shipping_address').prefetch_related('payment_details')
 
-    def calculate_amount_in_stock(self, order):
-        cart = Cart.objects.filter(id=order.product_list.id)
-        if not cart[0].status == Cart.PROCESSED:
-            raise APIException("Wrong cart status")
-        cart.update(status=Cart.CLOSED)
-        items = CartItem.objects.filter(cart=cart[0]).select_related('product').all()
-        for item in items:
-            cart_item_serializer = self.get_serializer(instance=item, data={"amount": item.amount,
-                                                                            "product": item.product_id},
-                                                       context={'id': item.id})
-            cart_item_serializer.is_valid(raise_exception=True)
-            item.product.amount_in_stock -= item.amount
-            item.product.save()
-
-    def post(self, request, *args, **kwargs):
+    def create(self, request, *args, **kwargs):
+        # Stock and the order status change in a background job, so checkout spikes queue up instead of
+        # holding web workers; the client polls the job for the receipt
         order = self.get_object()
-        self.calculate_amount_in_stock(order)
-        response = [
-            {
-                "Message": "Your payment has been processed successfully. Your order has been confirmed",
-                "Order_number": order.id,
-            },
-            {
-                "Order information":
-                    {
-                        "customer": {
-                            "name": order.customer.username
-                        },
-                        "product_list":
-                            {
-                                "cart_items": {
-                                    order.product_list.cart_items.values().filter(cart=order.product_list)
-                                }
-
-                            },
-                        "shipping_address": model_to_dict(order.shipping_address),
-                        "payment_details": model_to_dict(order.payment_details),
-                        "total_price": order.total_price,
-                        "order_status": order.get_order_status_display(),
-                        "created_date": order.created_date
-                    }
-            }
-        ]
-        order.order_status = PAID
-        order.paid = True
-        order.save()
-        return Response(response, status=status.HTTP_200_OK)
+        if order.order_status != Order.IN_PROCESS or order.paid or order.product_list.status != Cart.PROCESSED:
+            # anything else would only queue a job bound to fail
+            return Response({'Message': 'Only an unpaid order in process can be paid'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        job = enqueue(Job.ORDER_PAYMENT, {'order': order.id}, user=request.user)
+        status_url = reverse('job_detail_api', kwargs={'pk': job.pk})
+        serializer = self.get_serializer({'job': job.pk, 'status': job.status, 'status_url': status_url})
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED, headers={'Location': status_url})
+
+
+class JobDetail(generics.RetrieveAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = JobSerializer
+
+    def get_queryset(self):
+        if self.request.user.is_staff:
+            return Job.objects.all()
+        return Job.objects.filter(created_by=self.request.user)
+
+
+class ArchivedOrderMixin:
+    permission_classes = [IsAuthenticated]
+    serializer_class = ArchivedOrderSerializer
+
+    def get_queryset(self):
+        archived = ArchivedOrder.objects.order_by('-created_date', '-order_id')
+        if self.request.user.is_staff:
+            return archived
+        return archived.filter(customer=self.request.user)
+
+
+class ArchivedOrderList(ArchivedOrderMixin, generics.ListAPIView):
+    pass
+
+
+class ArchivedOrderDetail(ArchivedOrderMixin, generics.RetrieveAPIView):
+    lookup_field = 'order_id'
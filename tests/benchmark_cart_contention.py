@@ -0,0 +1,109 @@
+# Fires parallel add-to-cart requests at one cart and checks the resulting total.
+# Not collected by the default test run; start it explicitly:
+#     python -m pytest tests/benchmark_cart_contention.py -s
+# The in-memory test database can't be shared between threads, so this module runs on a SQLite file.
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import django
+import pytest
+from django.db import connection, transaction, OperationalError
+from django.db.models import F
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from store_app.models import Cart, CartItem, Product
+from tests.factory.product import ProductFactory
+from tests.factory.user import UserFactory
+
+THREADS = 8
+ADDS_PER_THREAD = 25
+
+
+@pytest.fixture(scope='session')
+def django_db_modify_db_settings(tmp_path_factory):
+    from django.conf import settings
+    database = settings.DATABASES['default']
+    database['TEST']['NAME'] = str(tmp_path_factory.mktemp('db') / 'benchmark.sqlite3')
+    database.setdefault('OPTIONS', {})['timeout'] = 60
+    if django.VERSION >= (5, 1):
+        # take the write lock when a transaction starts instead of failing on lock upgrade
+        database['OPTIONS']['transaction_mode'] = 'IMMEDIATE'
+
+
+def add_with_legacy_read_modify_write(user, product_id, amount):
+    # What CartItemCreateList.create used to do: read the total, add in Python, save the whole row
+    product = Product.objects.get(pk=product_id)
+    price = amount * product.price
+    cart = Cart.objects.filter(customer=user, status=Cart.OPEN)[0]
+    cart.total_price += price
+    cart.save()
+    CartItem.objects.create(cart=cart, product=product, amount=amount, price=price)
+
+
+def add_with_atomic_f_update(user, product_id, amount):
+    # The same steps as CartItemCreateList.create now takes, without the HTTP and serializer layers
+    product = Product.objects.get(pk=product_id)
+    price = amount * product.price
+    with transaction.atomic():
+        cart = Cart.objects.select_for_update().filter(customer=user, status=Cart.OPEN).first()
+        Cart.objects.filter(pk=cart.pk).update(total_price=F('total_price') + price)
+        CartItem.objects.create(cart=cart, product=product, amount=amount, price=price)
+
+
+def add_through_api(user, product_id, amount):
+    client = APIClient()
+    client.force_authenticate(user=user)
+    response = client.post(reverse('item_create_list_remove_api'), {"product": product_id, "amount": amount},
+                           format='json')
+    assert response.status_code == 201, response.data
+
+
+def run_parallel(add, user, product_ids):
+    def worker(thread):
+        failures = 0
+        try:
+            for product_id in product_ids[thread::THREADS]:
+                try:
+                    add(user, product_id, 1)
+                except OperationalError:
+                    failures += 1
+        finally:
+            connection.close()
+        return failures
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        failures = sum(executor.map(worker, range(THREADS)))
+    return time.perf_counter() - started, failures
+
+
+def measure(add):
+    user = UserFactory()
+    # a cart holds one line per product, so every add uses its own product and creates a line
+    products = ProductFactory.create_batch(THREADS * ADDS_PER_THREAD, image=None, price=Decimal('1.00'),
+                                           amount_in_stock=100000)
+    cart = Cart.objects.create(customer=user)
+    elapsed, failures = run_parallel(add, user, [product.id for product in products])
+    cart.refresh_from_db()
+    items = CartItem.objects.filter(cart=cart).count()
+    return elapsed, failures, items, cart.total_price
+
+
+@pytest.mark.django_db(transaction=True)
+def test_benchmark_cart_contention():
+    adds = THREADS * ADDS_PER_THREAD
+    results = {
+        'legacy read-modify-write': measure(add_with_legacy_read_modify_write),
+        'atomic F() update': measure(add_with_atomic_f_update),
+        'atomic F() update (API)': measure(add_through_api),
+    }
+    for name, (elapsed, failures, items, total) in results.items():
+        # every item adds 1.00, so the total counts the adds that were not lost
+        print("\n%s: %s adds in %.2fs, %s failed, total %s of %s, %.0f correct adds/s" % (
+            name, adds, elapsed, failures, total, items, total / Decimal(elapsed)))
+    _, failures, items, total = results['atomic F() update (API)']
+    assert failures == 0
+    assert items == adds
+    assert total == Decimal(adds)
@@ -0,0 +1,66 @@
+# Times the stock decrement at payment for carts of 1, 10 and 100 lines.
+# Not collected by the default test run; start it explicitly:
+#     python -m pytest tests/benchmark_payment.py -s
+import time
+
+import pytest
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from store_app.models import Cart, CartItem, Product
+from store_app.payments import decrement_stock
+from tests.factory.order import OrderFactory
+from tests.factory.product import ProductFactory
+from tests.factory.user import UserFactory
+
+CART_SIZES = (1, 10, 100)
+ROUNDS = 5
+
+
+def pay_with_legacy_per_line_saves(order):
+    # What OrderPayment used to do: re-validate every line, then save each product on its own
+    cart = Cart.objects.filter(id=order.product_list_id)
+    cart.update(status=Cart.CLOSED)
+    for item in CartItem.objects.filter(cart_id=order.product_list_id).select_related('product'):
+        CartItem.objects.get(pk=item.pk)
+        product = Product.objects.get(pk=item.product_id)
+        assert product.amount_in_stock >= item.amount
+        item.product.amount_in_stock -= item.amount
+        item.product.save()
+
+
+def pay_with_conditional_updates(order):
+    with transaction.atomic():
+        decrement_stock(order)
+
+
+def make_order(user, products):
+    cart = Cart.objects.create(customer=user, status=Cart.PROCESSED)
+    CartItem.objects.bulk_create([CartItem(cart=cart, product=product, amount=1, price=product.price)
+                                  for product in products])
+    return OrderFactory(customer=user, product_list=cart)
+
+
+def measure(pay, user, products):
+    elapsed, queries = [], 0
+    for _ in range(ROUNDS):
+        order = make_order(user, products)
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            pay(order)
+            elapsed.append(time.perf_counter() - started)
+        queries = len(captured)
+    return min(elapsed), queries
+
+
+@pytest.mark.django_db
+def test_benchmark_payment():
+    user = UserFactory()
+    products = ProductFactory.create_batch(max(CART_SIZES), image=None, amount_in_stock=10 ** 6)
+    for size in CART_SIZES:
+        legacy_time, legacy_queries = measure(pay_with_legacy_per_line_saves, user, products[:size])
+        new_time, new_queries = measure(pay_with_conditional_updates, user, products[:size])
+        print("\n%s lines: per-line saves %.1f ms / %s queries, conditional updates %.1f ms / %s queries (%.1fx)" % (
+            size, legacy_time * 1000, legacy_queries, new_time * 1000, new_queries, legacy_time / new_time))
+        assert new_queries < legacy_queries or size == 1
+    assert Product.objects.filter(amount_in_stock__lt=0).count() == 0
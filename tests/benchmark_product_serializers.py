@@ -0,0 +1,42 @@
+# Compares ProductSerializer with ProductFastSerializer on one large page of products.
+# Not collected by the default test run; start it explicitly:
+#     python -m pytest tests/benchmark_product_serializers.py -s
+import timeit
+
+import pytest
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from store_app.models import Product
+from store_app.serializers import ProductSerializer, ProductFastSerializer, ProductRow
+from tests.factory.category import CategoryFactory
+from tests.factory.product import ProductFactory
+
+PRODUCTS = 500
+CATEGORIES_PER_PRODUCT = 3
+ROUNDS = 5
+
+
+@pytest.mark.django_db
+def test_benchmark_product_serializers():
+    categories = CategoryFactory.create_batch(20)
+    for i in range(PRODUCTS):
+        product = ProductFactory(image=None)
+        product.category.add(*[categories[(i + j) % len(categories)] for j in range(CATEGORIES_PER_PRODUCT)])
+    request = APIRequestFactory().get('/product/')
+    context = {'request': request}
+
+    def drf_path():
+        products = Product.objects.prefetch_related('category').order_by('id')
+        return JSONRenderer().render(ProductSerializer(products, many=True, context=context).data)
+
+    def fast_path():
+        rows = Product.objects.order_by('id').values(*ProductRow.FIELDS)
+        return JSONRenderer().render(ProductFastSerializer(context).serialize(list(rows)))
+
+    assert drf_path() == fast_path()
+    drf_time = min(timeit.repeat(drf_path, number=1, repeat=ROUNDS))
+    fast_time = min(timeit.repeat(fast_path, number=1, repeat=ROUNDS))
+    print("\n%s products: ProductSerializer %.1f ms, ProductFastSerializer %.1f ms (%.1fx)" % (
+        PRODUCTS, drf_time * 1000, fast_time * 1000, drf_time / fast_time))
+    assert fast_time < drf_time
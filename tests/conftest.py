@@ -1 +1,18 @@
+import pytest
+from django.core.cache import cache
+
 pytest_plugins = ["tests.fixtures"]
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def media_settings(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    # The process pool is forked once and keeps the settings it saw, so tests resize in-process
+    settings.PRODUCT_IMAGE_WORKERS = 0
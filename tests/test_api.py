@@ -1,9 +1,33 @@
+import csv
+import json
+from datetime import timedelta
 from decimal import Decimal
+from io import StringIO
 
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 import pytest
-
-from store_app.models import Order
+from PIL import Image
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.renderers import JSONRenderer
+
+from store_app.checks import check_shared_cache
+from store_app.facets import get_facets
+from store_app import images, jobs
+from store_app.images import variant_name
+from store_app.importers import ProductImporter
+from store_app.models import Order, Product, Cart, CartItem, StockReservation, IdempotencyKey, Job, \
+    DailySales, DailyProductSales, PaymentDetails, ArchivedOrder
+from store_app.serializers import ProductSerializer
+from tests.factory.cart_item import CartItemFactory
+from tests.factory.order import OrderFactory
+from tests.factory.payment_details import PaymentDetailsFactory
+from tests.factory.product import ProductFactory
 
 IN_PROCESS = 1
 NOT_COMPLETED = 2
@@ -97,6 +121,273 @@ def test_product_list(api_client_auth, products):
     assert response.data['count'] == 4
 
 
+@pytest.mark.django_db
+def test_product_search(api_client_unauth, products):
+    products[1].name = "Green kiwi"
+    products[1].save()
+    products[0].description = "Tastes a bit like kiwi"
+    products[0].save()
+    url = reverse('product_list_create_api')
+    client, _ = api_client_unauth
+    response = client.get(url, {"q": "kiw"})
+    assert response.status_code == 200
+    assert response.data['count'] == 2
+    assert [product["name"] for product in response.data['results']] == ["Green kiwi", products[0].name]
+    # asking for cursor paging doesn't trade the ranking for id order
+    response = client.get(url, {"q": "kiw", "pagination": "cursor"})
+    assert [product["name"] for product in response.data['results']] == ["Green kiwi", products[0].name]
+
+
+@pytest.mark.django_db
+def test_product_search_index_follows_delete(api_client_unauth, product, django_capture_on_commit_callbacks):
+    product.name = "Banana"
+    product.save()
+    url = reverse('product_list_create_api')
+    client, _ = api_client_unauth
+    assert client.get(url, {"q": "banana"}).data['count'] == 1
+    with django_capture_on_commit_callbacks(execute=True):
+        product.delete()
+    assert client.get(url, {"q": "banana"}).data['count'] == 0
+
+
+@pytest.mark.django_db
+def test_rebuild_product_search_index(api_client_unauth, products):
+    Product.objects.filter(id=products[0].id).update(name="Cucumber")
+    url = reverse('product_list_create_api')
+    client, _ = api_client_unauth
+    assert client.get(url, {"q": "cucumber"}).data['count'] == 0
+    call_command('rebuild_product_search_index', stdout=StringIO())
+    assert client.get(url, {"q": "cucumber"}).data['count'] == 1
+
+
+@pytest.mark.django_db
+def test_product_list_cursor_pagination(api_client_unauth, products):
+    url = reverse('product_list_create_api')
+    client, _ = api_client_unauth
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, {"pagination": "cursor"})
+    assert response.status_code == 200
+    assert "count" not in response.data
+    assert not any("COUNT(" in query["sql"] for query in queries.captured_queries)
+    names = [product["name"] for product in response.data['results']]
+    response = client.get(response.data['next'])
+    names += [product["name"] for product in response.data['results']]
+    assert response.data['next'] is None
+    assert names == [product.name for product in products]
+
+
+@pytest.mark.django_db
+def test_product_list_etag(api_client_unauth, products, django_assert_num_queries):
+    url = reverse('product_list_create_api')
+    client, _ = api_client_unauth
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response['ETag']
+    with django_assert_num_queries(0):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.data['count'] == 4
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+
+
+def test_shared_cache_check(settings):
+    settings.DEBUG = False
+    assert [warning.id for warning in check_shared_cache(None)] == ['store_app.W001']
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                   'LOCATION': 'redis://127.0.0.1:6379'}}
+    assert check_shared_cache(None) == []
+
+
+@pytest.mark.django_db
+def test_product_detail_cache_invalidated_on_save(api_client_unauth, product, django_capture_on_commit_callbacks):
+    url = reverse('product_update_detail_remove_api', kwargs={'pk': product.id})
+    client, _ = api_client_unauth
+    etag = client.get(url)['ETag']
+    with django_capture_on_commit_callbacks(execute=True):
+        product.name = "Kiwi"
+        product.save()
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.data["name"] == "Kiwi"
+    assert response['ETag'] != etag
+
+
+@pytest.mark.django_db
+def test_product_facets(api_client_unauth, products):
+    url = reverse('product_facets_api')
+    client, _ = api_client_unauth
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.data['count'] == 4
+    assert [band['count'] for band in response.data['price']] == [1, 3, 0, 0]
+    assert [category['count'] for category in response.data['category']] == [1, 1, 1, 1]
+    response = client.get(url, {"min_price": 15})
+    assert response.data['count'] == 2
+    assert [category['id'] for category in response.data['category']] == [3, 4]
+
+
+@pytest.mark.django_db
+def test_product_facets_follow_product_changes(api_client_unauth, products, categories,
+                                               django_capture_on_commit_callbacks):
+    url = reverse('product_facets_api')
+    client, _ = api_client_unauth
+    client.get(url)
+    with django_capture_on_commit_callbacks(execute=True):
+        products[0].price = 75
+        products[0].amount_in_stock = 0
+        products[0].save()
+        products[1].category.add(categories[0])
+        products[2].delete()
+        ProductFactory(price=150).category.add(categories[3])
+        categories[1].name = "Renamed"
+        categories[1].save()
+    assert client.get(url).data == get_facets(Product.objects.all())
+
+
+@pytest.mark.django_db
+def test_product_import_csv(api_client_admin, categories, product_not_categorized):
+    url = reverse('product_import_api')
+    client, _ = api_client_admin
+    upload = SimpleUploadedFile("catalog.csv", (
+        "id,name,description,price,amount_in_stock,category\n"
+        ",Kiwi,Green kiwi fruit,6.90,100,1|2\n"
+        ",Banana,,abc,10,\n"
+        ",Cucumber,,2.10,5,9\n"
+        "%s,Renamed,,3.00,7,3\n" % product_not_categorized.id).encode())
+    response = client.post(url, {"file": upload}, format='multipart')
+    assert response.status_code == 200
+    assert response.data['created'] == 1
+    assert response.data['updated'] == 1
+    assert [error['row'] for error in response.data['errors']] == [2, 3]
+    kiwi = Product.objects.get(name="Kiwi")
+    assert sorted(kiwi.category.values_list('id', flat=True)) == [1, 2]
+    product_not_categorized.refresh_from_db()
+    assert product_not_categorized.name == "Renamed"
+    assert list(product_not_categorized.category.values_list('id', flat=True)) == [3]
+
+
+@pytest.mark.django_db
+def test_product_import_partial_update(products):
+    Product.objects.filter(id=products[0].id).update(description="Long description", name="Apple")
+    importer = ProductImporter()
+    report = importer.run(iter([{"id": products[0].id, "price": "2.00"},
+                                {"id": products[1].id, "name": "Pear", "amount_in_stock": 3}]))
+    assert (report['updated'], report['errors']) == (2, [])
+    first, second = Product.objects.get(id=products[0].id), Product.objects.get(id=products[1].id)
+    assert (first.name, first.description, first.price) == ("Apple", "Long description", Decimal("2.00"))
+    assert (second.name, second.amount_in_stock, second.price) == ("Pear", 3, products[1].price)
+
+
+@pytest.mark.django_db
+def test_product_import_user(api_client_auth):
+    url = reverse('product_import_api')
+    client, _ = api_client_auth
+    upload = SimpleUploadedFile("catalog.jsonl", b'{"name": "Kiwi", "price": "1.00", "amount_in_stock": 3}\n')
+    response = client.post(url, {"file": upload}, format='multipart')
+    assert response.status_code == 403
+
+
+@pytest.mark.django_db
+def test_import_products_command(tmp_path, categories):
+    path = tmp_path / "catalog.jsonl"
+    path.write_text('{"name": "Kiwi", "price": "1.00", "amount_in_stock": 3, "category": [4]}\n'
+                    'not json\n'
+                    '{"name": "Banana", "price": "2.00", "amount_in_stock": 8}\n')
+    call_command('import_products', str(path), '--batch-size', '2', stdout=StringIO(), stderr=StringIO())
+    assert sorted(Product.objects.values_list('name', flat=True)) == ["Banana", "Kiwi"]
+    assert list(Product.objects.get(name="Kiwi").category.values_list('id', flat=True)) == [4]
+
+
+@pytest.mark.django_db
+def test_product_export_ndjson(api_client_admin, products):
+    url = reverse('product_export_api')
+    client, _ = api_client_admin
+    response = client.get(url, {"file_format": "ndjson"})
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+    assert [row["id"] for row in rows] == [1, 2, 3, 4]
+    assert [row["category"] for row in rows] == [[1], [2], [3], [4]]
+    assert rows[0]["name"] == products[0].name
+
+
+@pytest.mark.django_db
+def test_export_products_command_csv_round_trip(tmp_path, products):
+    path = tmp_path / "catalog.csv"
+    call_command('export_products', '--format', 'csv', '--output', str(path), '--chunk-size', '3')
+    Product.objects.filter(id=2).update(name="Changed")
+    call_command('import_products', str(path), stdout=StringIO(), stderr=StringIO())
+    assert Product.objects.get(id=2).name == products[1].name
+    assert Product.objects.count() == 4
+
+
+@pytest.mark.django_db
+def test_product_image_variants(api_client_unauth, settings, tmp_path, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        product = ProductFactory(image__width=1000, image__height=500)
+    url = reverse('product_update_detail_remove_api', kwargs={'pk': product.id})
+    client, _ = api_client_unauth
+    response = client.get(url)
+    assert set(response.data['image_variants']) == set(settings.PRODUCT_IMAGE_VARIANTS)
+    thumbnail = variant_name(product.image.name, 'thumbnail_webp')
+    assert response.data['image_variants']['thumbnail_webp'].endswith(thumbnail)
+    with Image.open(tmp_path / thumbnail) as image:
+        assert image.format == "WEBP"
+        assert image.size == (200, 100)
+
+
+def test_image_variant_names_are_distinct():
+    names = {variant_name(name, 'thumbnail') for name in ('images/a.jpg', 'images/a.png', 'images/x/a.jpg')}
+    assert len(names) == 3
+
+
+@pytest.mark.django_db
+def test_generate_image_variants_command(settings, tmp_path, monkeypatch):
+    settings.PRODUCT_IMAGE_WORKERS = 1
+    monkeypatch.setattr(images, '_executor', None)
+    product = ProductFactory()
+    (tmp_path / "images" / "notes.txt").write_text("not an image")
+    call_command('generate_image_variants', '--all-files', stdout=StringIO(), stderr=StringIO())
+    images.get_executor().shutdown()
+    for variant in settings.PRODUCT_IMAGE_VARIANTS:
+        assert (tmp_path / variant_name(product.image.name, variant)).exists()
+
+
+@pytest.mark.django_db
+def test_product_fast_serializer_matches_product_serializer(api_client_unauth, products, categories,
+                                                           product_not_categorized):
+    products[0].category.add(categories[2], categories[1])
+    Product.objects.filter(id=products[1].id).update(rating_sum=7, rating_count=3, image='')
+    url = reverse('product_list_create_api')
+    client, _ = api_client_unauth
+    response = client.get(url, {"page": 1})
+    request = response.wsgi_request
+    expected = ProductSerializer(Product.objects.order_by('id')[:3], many=True, context={'request': request}).data
+    assert response.content == JSONRenderer().render({
+        "count": 5, "next": "http://testserver/product/?page=2", "previous": None, "results": expected})
+    url = reverse('product_update_detail_remove_api', kwargs={'pk': products[1].id})
+    response = client.get(url)
+    expected = ProductSerializer(Product.objects.get(id=products[1].id), context={'request': request}).data
+    assert response.content == JSONRenderer().render(expected)
+
+
+@pytest.mark.django_db
+def test_product_filter_category_id(api_client_unauth, products, categories, django_assert_num_queries):
+    products[0].category.add(categories[1])
+    url = reverse('product_list_create_api')
+    client, _ = api_client_unauth
+    response = client.get(url, {"category_id": "1,2"})
+    assert response.status_code == 200
+    assert response.data['count'] == 2
+    assert [product["name"] for product in response.data['results']] == [products[0].name, products[1].name]
+    with django_assert_num_queries(0):
+        response = client.get(url, {"category_id": "2,1,2"})
+        assert client.get(url, {"category_id": "02, 1"}).data == response.data
+    assert response.data['count'] == 2
+    assert client.get(url, {"category_id": "x"}).status_code == 400
+    assert client.get(url, {"category_id": "1.9"}).status_code == 400
+
+
 @pytest.mark.django_db
 def test_product_user_create(api_client_admin, category):
     url = reverse('product_list_create_api')
@@ -189,6 +480,19 @@ def test_feedback_user_create(api_client_auth, order_paid):
     assert "rate" in response.data
 
 
+@pytest.mark.django_db
+def test_feedback_for_archived_order(api_client_auth, order_paid):
+    product = order_paid.product_list.cart_items.first().product
+    Order.objects.filter(pk=order_paid.pk).update(order_status=Order.RECEIVED,
+                                                  created_date=timezone.now() - timedelta(days=400))
+    call_command('apply_retention', stdout=StringIO())
+    assert not Order.objects.exists()
+    client, _ = api_client_auth
+    response = client.post(reverse('feedback_list_create_api', kwargs={'pk': product.id}),
+                           {"rate": 4, "text": "still good"}, format='json')
+    assert response.status_code == 201
+
+
 @pytest.mark.django_db
 def test_feedback_update(api_client_auth, feedback, product):
     url = reverse('feedback_update_detail_remove_api', kwargs={'feedback_pk': feedback.id, 'pk': product.id})
@@ -226,6 +530,43 @@ def test_feedback_delete(api_client_auth, feedback, product):
     assert response.status_code == 204
 
 
+@pytest.mark.django_db
+def test_feedback_create_updates_product_rating(api_client_auth, order_paid):
+    product = order_paid.product_list.cart_items.first().product
+    url = reverse('feedback_list_create_api', kwargs={'pk': product.id})
+    client, _ = api_client_auth
+    response = client.post(url, {"rate": 5, "text": "delicious"}, format='json')
+    assert response.status_code == 201
+    product.refresh_from_db()
+    assert product.rating_sum == 5
+    assert product.rating_count == 1
+    assert product.feedback_rate == 5
+
+
+@pytest.mark.django_db
+def test_feedback_update_and_delete_update_product_rating(api_client_auth, feedback, product):
+    call_command('rebuild_product_ratings', stdout=StringIO())
+    url = reverse('feedback_update_detail_remove_api', kwargs={'feedback_pk': feedback.id, 'pk': product.id})
+    client, _ = api_client_auth
+    response = client.patch(url, {"rate": 2}, format='json')
+    assert response.status_code == 200
+    product.refresh_from_db()
+    assert (product.rating_sum, product.rating_count) == (2, 1)
+    response = client.delete(url)
+    assert response.status_code == 204
+    product.refresh_from_db()
+    assert (product.rating_sum, product.rating_count) == (0, 0)
+    assert product.feedback_rate is None
+
+
+@pytest.mark.django_db
+def test_rebuild_product_ratings(feedbacks, product):
+    call_command('rebuild_product_ratings', '--chunk-size', '1', stdout=StringIO())
+    product.refresh_from_db()
+    assert product.rating_count == 3
+    assert product.rating_sum == sum(feedback.rate for feedback in feedbacks)
+
+
 @pytest.mark.django_db
 def test_orders_user(api_client_auth, orders):
     url = reverse('order_list_api')
@@ -253,6 +594,162 @@ def test_cart_item_create(api_client_auth, product, cart):
     assert "amount" in response.data
 
 
+@pytest.mark.django_db
+def test_cart_item_changes_update_cart_total(api_client_auth, product, cart):
+    client, user = api_client_auth
+    initial_total = Cart.objects.filter(customer=user, status=Cart.OPEN).first().total_price
+    response = client.post(reverse('item_create_list_remove_api'), {"product": product.id, "amount": 2},
+                           format='json')
+    assert response.status_code == 201
+    item = CartItem.objects.select_related('cart').get(cart__customer=user, product=product)
+    assert item.cart.total_price == initial_total + 2 * product.price
+    url = reverse('item_update_detail_remove_api', kwargs={'pk': item.id})
+    response = client.patch(url, {"amount": 3}, format='json')
+    assert response.status_code == 200
+    assert Decimal(response.data["price"]) == 3 * product.price
+    item.cart.refresh_from_db()
+    assert item.cart.total_price == initial_total + 3 * product.price
+    assert client.delete(url).status_code == 204
+    item.cart.refresh_from_db()
+    assert item.cart.total_price == initial_total
+
+
+@pytest.mark.django_db
+def test_cart_item_create_merges_same_product(api_client_auth, product, cart):
+    client, user = api_client_auth
+    url = reverse('item_create_list_remove_api')
+    assert client.post(url, {"product": product.id, "amount": 1}, format='json').status_code == 201
+    response = client.post(url, {"product": product.id, "amount": 2}, format='json')
+    assert response.status_code == 200
+    assert response.data["amount"] == 3
+    item = CartItem.objects.get(cart__customer=user, product=product)
+    assert (item.amount, item.price) == (3, 3 * product.price)
+
+
+@pytest.mark.django_db
+def test_cart_item_writes_load_each_object_once(api_client_auth, product, cart):
+    client, user = api_client_auth
+
+    def loads(queries, column):
+        # queries that read whole rows, as opposed to locks and sums over them
+        return [query for query in queries.captured_queries
+                if query['sql'].startswith('SELECT') and column in query['sql']]
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post(reverse('item_create_list_remove_api'), {"product": product.id, "amount": 1},
+                               format='json')
+    assert response.status_code == 201
+    assert len(loads(queries, '"store_app_product"."name"')) == 1
+    item = CartItem.objects.get(cart__customer=user, product=product)
+    url = reverse('item_update_detail_remove_api', kwargs={'pk': item.id})
+    with CaptureQueriesContext(connection) as queries:
+        response = client.patch(url, {"amount": 2}, format='json')
+    assert response.status_code == 200
+    # the line and its product arrive in one joined query that validate() then reads from
+    assert len(loads(queries, '"store_app_cartitem"."amount"')) == 1
+    assert len(loads(queries, '"store_app_product"."name"')) == 1
+
+
+@pytest.mark.django_db
+def test_cart_items_reserve_stock(api_client_auth, api_client_user, product):
+    Product.objects.filter(pk=product.pk).update(amount_in_stock=5)
+    product.refresh_from_db()
+    client, user = api_client_auth
+    other_client, _ = api_client_user
+    url = reverse('item_create_list_remove_api')
+    assert client.post(url, {"product": product.id, "amount": 4}, format='json').status_code == 201
+    assert other_client.post(url, {"product": product.id, "amount": 2}, format='json').status_code == 400
+    assert StockReservation.objects.available(product) == 1
+    item = CartItem.objects.get(cart__customer=user, product=product)
+    assert client.delete(reverse('item_update_detail_remove_api', kwargs={'pk': item.id})).status_code == 204
+    assert other_client.post(url, {"product": product.id, "amount": 2}, format='json').status_code == 201
+
+
+@pytest.mark.django_db
+def test_release_expired_reservations(api_client_auth, api_client_user, product):
+    Product.objects.filter(pk=product.pk).update(amount_in_stock=5)
+    product.refresh_from_db()
+    client, _ = api_client_auth
+    other_client, _ = api_client_user
+    url = reverse('item_create_list_remove_api')
+    assert client.post(url, {"product": product.id, "amount": 5}, format='json').status_code == 201
+    StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+    # an expired hold no longer counts, even before the sweeper removes it
+    assert StockReservation.objects.available(product) == 5
+    out = StringIO()
+    call_command('release_expired_reservations', '--batch-size', '1', stdout=out)
+    assert "Released 1 expired stock reservations" in out.getvalue()
+    assert other_client.post(url, {"product": product.id, "amount": 5}, format='json').status_code == 201
+
+
+@pytest.mark.django_db
+def test_cart_batch(api_client_auth, non_empty_cart, products):
+    cart = non_empty_cart[0].cart
+    client, user = api_client_auth
+    Cart.objects.filter(customer=user).exclude(pk=cart.pk).delete()
+    Product.objects.update(amount_in_stock=10 ** 6)
+    # the factories write lines directly, so start the counters from the lines themselves
+    counters = CartItem.objects.filter(cart=cart).aggregate(items=Sum('amount'), lines=Count('id'))
+    Cart.objects.filter(pk=cart.pk).update(item_count=counters['items'], distinct_products=counters['lines'])
+    operations = [
+        {"op": "add", "product": products[0].id, "amount": 1},
+        {"op": "update", "item": non_empty_cart[1].id, "amount": 2},
+        {"op": "remove", "item": non_empty_cart[2].id},
+    ]
+    response = client.post(reverse('cart_batch_api'), {"operations": operations}, format='json')
+    assert response.status_code == 200
+    # the added product was already in the cart, so its line grew instead of a fourth line appearing
+    assert len(response.data['cart_items']) == 3
+    assert response.data['cart_items'][0]['amount'] == non_empty_cart[0].amount + 1
+    expected_total = cart.total_price + (non_empty_cart[0].amount + 1) * products[0].price - non_empty_cart[0].price \
+        + 2 * products[1].price - non_empty_cart[1].price - non_empty_cart[2].price
+    assert Decimal(response.data['total_price']) == expected_total
+    cart.refresh_from_db()
+    assert cart.total_price == expected_total
+    assert cart.item_count == counters['items'] + 1 + 2 - non_empty_cart[1].amount - non_empty_cart[2].amount
+    assert cart.distinct_products == counters['lines'] - 1
+
+
+@pytest.mark.django_db
+def test_cart_batch_rolls_back_on_error(api_client_auth, non_empty_cart, products):
+    client, user = api_client_auth
+    Cart.objects.filter(customer=user).exclude(pk=non_empty_cart[0].cart_id).delete()
+    operations = [
+        {"op": "remove", "item": non_empty_cart[0].id},
+        {"op": "add", "product": products[1].id, "amount": products[1].amount_in_stock + 1},
+        {"op": "update", "item": 999, "amount": 1},
+    ]
+    response = client.post(reverse('cart_batch_api'), {"operations": operations}, format='json')
+    assert response.status_code == 400
+    assert [int(error['index']) for error in response.data['operations']] == [1, 2]
+    assert CartItem.objects.filter(id=non_empty_cart[0].id).exists()
+
+
+@pytest.mark.django_db
+def test_cart_summary(api_client_auth, products, django_assert_num_queries):
+    client, user = api_client_auth
+    first, second = products[:2]
+    Product.objects.filter(pk__in=[first.pk, second.pk]).update(amount_in_stock=100)
+    url = reverse('item_create_list_remove_api')
+    client.post(url, {"product": first.id, "amount": 2}, format='json')
+    client.post(url, {"product": first.id, "amount": 1}, format='json')
+    client.post(url, {"product": second.id, "amount": 4}, format='json')
+    item = CartItem.objects.get(cart__customer=user, product=second)
+    client.patch(reverse('item_update_detail_remove_api', kwargs={'pk': item.id}), {"amount": 5}, format='json')
+    response = client.get(reverse('cart_summary_api'))
+    assert response.status_code == 200
+    cart = Cart.objects.get(customer=user)
+    assert response.data == {'item_count': 8, 'distinct_products': 2, 'total_price': str(cart.total_price)}
+    assert cart.total_price == 3 * first.price + 5 * second.price
+    with django_assert_num_queries(1):
+        response = client.get(reverse('cart_summary_api'), HTTP_IF_NONE_MATCH=response['ETag'])
+    assert response.status_code == 304
+    client.delete(reverse('item_update_detail_remove_api', kwargs={'pk': item.id}))
+    response = client.get(reverse('cart_summary_api'), HTTP_IF_NONE_MATCH=response['ETag'])
+    assert response.status_code == 200
+    assert (response.data['item_count'], response.data['distinct_products']) == (3, 1)
+
+
 @pytest.mark.django_db
 def test_cart_item_list(api_client_auth, cart):
     url = reverse('item_create_list_remove_api')
@@ -279,6 +776,18 @@ def test_cart_item_update(api_client_auth, cart_item, product, cart):
     assert response.data["amount"] == 8
 
 
+@pytest.mark.django_db
+def test_cart_item_update_to_product_in_cart(api_client_auth, non_empty_cart):
+    items = non_empty_cart
+    Product.objects.update(amount_in_stock=10)
+    url = reverse('item_update_detail_remove_api', kwargs={'pk': items[0].id})
+    client, _ = api_client_auth
+    response = client.patch(url, {"product": items[1].product_id, "amount": 1}, format='json')
+    assert response.status_code == 400
+    assert "product" in response.data
+    assert CartItem.objects.get(pk=items[0].pk).product_id == items[0].product_id
+
+
 @pytest.mark.django_db
 def test_cart_item_detail(api_client_auth, cart_item):
     url = reverse('item_update_detail_remove_api', kwargs={'pk': cart_item.id})
@@ -305,6 +814,37 @@ def test_order_list(api_client_auth, orders):
     assert response.data['count'] == 4
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize('orders_count, items_per_cart', [(1, 1), (8, 6)])
+def test_order_list_query_budget(api_client_admin, orders_count, items_per_cart, django_assert_num_queries):
+    client, _ = api_client_admin
+    for order in OrderFactory.create_batch(orders_count):
+        CartItemFactory.create_batch(items_per_cart, cart=order.product_list)
+        Order.objects.filter(pk=order.pk).update(lines=Order.snapshot_lines(order.product_list_id))
+    # the page count and the orders joined to their customers: the same for any page or cart size
+    with django_assert_num_queries(2):
+        response = client.get(reverse('order_list_api'))
+    assert response.status_code == 200
+    assert len(response.data['results']) == min(orders_count, PageNumberPagination.page_size)
+    assert all(len(order['lines']) == items_per_cart for order in response.data['results'])
+    order = Order.objects.first()
+    with django_assert_num_queries(1):
+        response = client.get(reverse('order_update_detail_remove_api', kwargs={'pk': order.id}))
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_order_list_cursor_pagination(api_client_auth, orders):
+    url = reverse('order_list_create_api')
+    client, _ = api_client_auth
+    response = client.get(url, {"pagination": "cursor"})
+    assert response.status_code == 200
+    assert len(response.data['results']) == 3
+    response = client.get(response.data['next'])
+    assert len(response.data['results']) == 1
+    assert response.data['next'] is None
+
+
 @pytest.mark.django_db
 def test_order_create(api_client_auth, user2, cart_filled, shipping_address, payment_details):
     url = reverse('order_list_create_api')
@@ -314,6 +854,23 @@ def test_order_create(api_client_auth, user2, cart_filled, shipping_address, pay
     assert response.status_code == 400
 
 
+@pytest.mark.django_db
+def test_order_create_freezes_lines(api_client_auth, non_empty_cart, few_shipping_address, few_payment_details):
+    client, user = api_client_auth
+    Cart.objects.filter(customer=user).exclude(pk=non_empty_cart[0].cart_id).delete()
+    response = client.post(reverse('order_list_create_api'), {}, format='json')
+    assert response.status_code == 201
+    item = CartItem.objects.select_related('product').get(pk=non_empty_cart[0].pk)
+    assert response.data['lines'][0] == {'product': item.product_id, 'name': item.product.name,
+                                         'price': str(item.product.price), 'amount': item.amount,
+                                         'total': str(item.price)}
+    Product.objects.filter(pk=item.product_id).update(name='Renamed', price=Decimal('0.01'))
+    # history shows what was bought, not what the product looks like now
+    order = client.get(reverse('order_list_create_api')).data['results'][0]
+    assert order['lines'] == response.data['lines']
+    assert len(order['lines']) == len(non_empty_cart)
+
+
 @pytest.mark.django_db
 def test_order_update(api_client_auth, order, shipping_address2):
     url = reverse('order_update_detail_remove_api', kwargs={'pk': order.id})
@@ -351,6 +908,86 @@ def test_order_change_status(api_client_admin, order):
     assert "order_status" in response.data
 
 
+@pytest.mark.django_db
+def test_order_bulk_status(api_client_admin, django_assert_max_num_queries):
+    client, _ = api_client_admin
+    paid = OrderFactory.create_batch(3, order_status=Order.PAID)
+    sent = OrderFactory(order_status=Order.SENT)
+    not_completed = OrderFactory(order_status=Order.NOT_COMPLETED)
+    in_process = OrderFactory(order_status=Order.IN_PROCESS)
+    transitions = [{"id": order.id, "order_status": Order.SENT} for order in paid] + [
+        {"id": sent.id, "order_status": Order.DELIVERED},
+        {"id": not_completed.id, "order_status": Order.DELIVERED},
+        {"id": 10 ** 6, "order_status": Order.SENT},
+        {"id": in_process.id, "order_status": Order.PAID},
+    ]
+    # one read of the current statuses, then an UPDATE and a read-back per target status, whatever the number
+    # of orders
+    with django_assert_max_num_queries(7):
+        response = client.post(reverse('order_bulk_status_api'), {"transitions": transitions}, format='json')
+    assert response.status_code == 200
+    assert response.data['updated'] == 4
+    assert [row['result'] for row in response.data['results']] == \
+        ['updated'] * 4 + ['not_allowed', 'not_found', 'not_allowed']
+    assert set(Order.objects.filter(id__in=[order.id for order in paid]).values_list('order_status', flat=True)) \
+        == {Order.SENT}
+    assert Order.objects.get(pk=sent.pk).order_status == Order.DELIVERED
+    assert Order.objects.get(pk=not_completed.pk).order_status == Order.NOT_COMPLETED
+    # payment only happens through the payment pipeline, which takes the stock and records the sale
+    assert Order.objects.filter(pk=in_process.pk, order_status=Order.IN_PROCESS, paid=False).exists()
+    assert not DailySales.objects.exists()
+
+
+@pytest.mark.django_db
+def test_order_export_ndjson(api_client_admin, order_processed, django_assert_max_num_queries):
+    others = OrderFactory.create_batch(3, order_status=Order.PAID, lines=[])
+    url = reverse('order_export_api')
+    client, _ = api_client_admin
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/x-ndjson'
+    # one query each for the orders, their customers, addresses and the lines not frozen on them
+    with django_assert_max_num_queries(4):
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+    assert [row["id"] for row in rows] == [order_processed.id] + [order.id for order in others]
+    assert len(rows[0]["lines"]) == 4
+    assert rows[0]["customer"] == order_processed.customer.username
+    assert rows[0]["shipping_address"]["city"] == order_processed.shipping_address.city
+    assert rows[1]["order_status"] == "Paid. In process"
+    # resuming after the second order, paid orders only
+    response = client.get(url, {"order_status": Order.PAID, "after_id": others[0].id})
+    rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+    assert [row["id"] for row in rows] == [order.id for order in others[1:]]
+    assert client.get(url, {"start": "2024-02-01", "end": "2024-01-01"}).status_code == 400
+    assert client.get(url, {"file_format": "xml"}).status_code == 400
+
+
+@pytest.mark.django_db
+def test_order_export_csv(api_client_admin, api_client_auth, order_processed):
+    url = reverse('order_export_api')
+    client, _ = api_client_admin
+    today = timezone.localdate()
+    response = client.get(url, {"file_format": "csv", "start": today, "end": today})
+    assert response['Content-Type'] == 'text/csv'
+    rows = list(csv.DictReader(StringIO(b"".join(response.streaming_content).decode())))
+    # one row per line item
+    assert [row["product"] for row in rows] == \
+        [str(item.product_id) for item in CartItem.objects.filter(cart=order_processed.product_list).order_by('id')]
+    assert {row["id"] for row in rows} == {str(order_processed.id)}
+    response = client.get(url, {"file_format": "csv", "end": today - timedelta(days=1)})
+    assert len(b"".join(response.streaming_content).decode().splitlines()) == 1
+    user_client, _ = api_client_auth
+    assert user_client.get(url).status_code == 403
+
+
+@pytest.mark.django_db
+def test_order_bulk_status_user(api_client_auth, order):
+    client, _ = api_client_auth
+    response = client.post(reverse('order_bulk_status_api'),
+                           {"transitions": [{"id": order.id, "order_status": Order.SENT}]}, format='json')
+    assert response.status_code == 403
+
+
 @pytest.mark.django_db
 def test_order_receiving(api_client_auth, order):
     url = reverse('order_receiving_api', kwargs={'pk': order.id})
@@ -372,8 +1009,258 @@ def test_order_user_receiving(api_client_user, order):
 def test_order_payment(api_client_auth, order_processed, cart_filled):
     url = reverse('order_payment_api', kwargs={'pk': order_processed.id})
     client, _ = api_client_auth
+    items = list(CartItem.objects.filter(cart=order_processed.product_list))
+    for item in items:
+        Product.objects.filter(pk=item.product_id).update(amount_in_stock=item.amount + 3)
     response = client.post(url, format='json')
+    assert response.status_code == 202
+    # nothing changes until a worker picks the job up
+    assert Cart.objects.get(pk=order_processed.product_list_id).status == Cart.PROCESSED
+    assert jobs.work(burst=True) == 1
+    job = client.get(response['Location']).data
+    assert job['status'] == Job.DONE
+    assert job['result'][0]['Order_number'] == order_processed.id
+    assert set(Product.objects.filter(pk__in=[item.product_id for item in items])
+               .values_list('amount_in_stock', flat=True)) == {3}
+    assert Cart.objects.get(pk=order_processed.product_list_id).status == Cart.CLOSED
+    # the stored receipt doesn't keep the card
+    card = order_processed.payment_details
+    stored = json.dumps(Job.objects.get(pk=job['id']).result)
+    assert card.card_number not in stored and "cvv" not in stored
+    assert card.card_number[-4:] in stored
+    # finished jobs are purged once they are past their retention
+    out = StringIO()
+    call_command('purge_jobs', stdout=out)
+    assert "Purged 0 finished jobs" in out.getvalue()
+    Job.objects.update(finished_at=timezone.now() - timedelta(days=30))
+    call_command('purge_jobs', stdout=StringIO())
+    assert not Job.objects.exists()
+
+
+@pytest.mark.django_db
+def test_cart_writes_skip_processed_cart(api_client_auth, order_processed):
+    client, user = api_client_auth
+    processed = order_processed.product_list
+    lines = CartItem.objects.filter(cart=processed).count()
+    product = ProductFactory(image=None, amount_in_stock=10)
+    response = client.post(reverse('item_create_list_remove_api'), {"product": product.id, "amount": 1},
+                           format='json')
+    assert response.status_code == 201
+    batch = {"operations": [{"op": "add", "product": product.id, "amount": 1}]}
+    assert client.post(reverse('cart_batch_api'), batch, format='json').status_code == 200
+    # the ordered cart keeps the lines frozen on its order; the new ones went to a fresh open cart
+    assert CartItem.objects.filter(cart=processed).count() == lines
+    assert CartItem.objects.get(cart__customer=user, cart__status=Cart.OPEN, product=product).amount == 2
+
+
+@pytest.mark.django_db
+def test_order_payment_needs_order_in_process(api_client_auth, order_processed):
+    url = reverse('order_payment_api', kwargs={'pk': order_processed.id})
+    client, _ = api_client_auth
+    Order.objects.filter(pk=order_processed.pk).update(order_status=Order.NOT_COMPLETED)
+    Cart.objects.filter(pk=order_processed.product_list_id).update(status=Cart.OPEN)
+    assert client.post(url, format='json').status_code == 400
+    Order.objects.filter(pk=order_processed.pk).update(order_status=Order.IN_PROCESS)
+    assert client.post(url, format='json').status_code == 400
+    assert not Job.objects.exists()
+    assert client.options(url).status_code == 200
+
+
+@pytest.mark.django_db
+def test_order_payment_rolls_back_on_shortfall(api_client_auth, order_processed):
+    url = reverse('order_payment_api', kwargs={'pk': order_processed.id})
+    client, _ = api_client_auth
+    items = list(CartItem.objects.filter(cart=order_processed.product_list).order_by('product_id'))
+    for item in items:
+        Product.objects.filter(pk=item.product_id).update(amount_in_stock=item.amount)
+    Product.objects.filter(pk=items[-1].product_id).update(amount_in_stock=items[-1].amount - 1)
+    response = client.post(url, format='json')
+    assert response.status_code == 202
+    jobs.work(burst=True)
+    job = client.get(reverse('job_detail_api', kwargs={'pk': response.data['job']})).data
+    assert job['status'] == Job.FAILED
+    assert job['result']['status_code'] == 400
+    assert len(job['result']['detail']['products']) == 1
+    # the lines that could be paid for were rolled back with the one that couldn't
+    assert Product.objects.get(pk=items[0].product_id).amount_in_stock == items[0].amount
+    assert Cart.objects.get(pk=order_processed.product_list_id).status == Cart.PROCESSED
+    order_processed.refresh_from_db()
+    assert order_processed.order_status == Order.IN_PROCESS
+
+
+@pytest.mark.django_db
+def test_order_payment_idempotency_key(api_client_auth, order_processed):
+    url = reverse('order_payment_api', kwargs={'pk': order_processed.id})
+    client, _ = api_client_auth
+    item = CartItem.objects.filter(cart=order_processed.product_list).first()
+    CartItem.objects.filter(cart=order_processed.product_list).update(amount=1)
+    Product.objects.update(amount_in_stock=10)
+    first = client.post(url, format='json', HTTP_IDEMPOTENCY_KEY='pay-1')
+    retry = client.post(url, format='json', HTTP_IDEMPOTENCY_KEY='pay-1')
+    assert first.status_code == retry.status_code == 202
+    assert retry['Idempotent-Replayed'] == 'true'
+    assert retry.json() == first.json()
+    # the retry was answered from the stored response, so only one payment job was queued
+    assert jobs.work(burst=True) == 1
+    assert Product.objects.get(pk=item.product_id).amount_in_stock == 9
+
+
+@pytest.mark.django_db
+def test_order_create_idempotency_key(api_client_auth, non_empty_cart, api_client_user, few_shipping_address,
+                                      few_payment_details):
+    client, user = api_client_auth
+    Cart.objects.filter(customer=user).exclude(pk=non_empty_cart[0].cart_id).delete()
+    url = reverse('order_list_create_api')
+    first = client.post(url, {}, format='json', HTTP_IDEMPOTENCY_KEY='order-1')
+    assert first.status_code == 201
+    retry = client.post(url, {}, format='json', HTTP_IDEMPOTENCY_KEY='order-1')
+    assert (retry.status_code, retry.json()) == (201, first.json())
+    assert Order.objects.filter(customer=user).count() == 1
+    # keys are per user, and one key can't be reused for another endpoint
+    other_client, _ = api_client_user
+    assert other_client.post(url, {}, format='json', HTTP_IDEMPOTENCY_KEY='order-1').status_code == 400
+    payment_url = reverse('order_payment_api', kwargs={'pk': Order.objects.get(customer=user).pk})
+    assert client.post(payment_url, format='json', HTTP_IDEMPOTENCY_KEY='order-1').status_code == 422
+
+
+@pytest.mark.django_db
+def test_order_payment_idempotency_key_permissions(api_client_unauth, api_client_user, order_processed):
+    url = reverse('order_payment_api', kwargs={'pk': order_processed.id})
+    client, _ = api_client_unauth
+    assert client.post(url, format='json', HTTP_IDEMPOTENCY_KEY='pay-1').status_code == 401
+    other_client, _ = api_client_user
+    assert other_client.post(url, format='json', HTTP_IDEMPOTENCY_KEY='pay-1').status_code == 403
+    assert not IdempotencyKey.objects.exists()
+    assert not Job.objects.exists()
+
+
+@pytest.mark.django_db
+def test_idempotency_key_in_progress(api_client_auth, order_processed):
+    client, user = api_client_auth
+    url = reverse('order_payment_api', kwargs={'pk': order_processed.id})
+    IdempotencyKey.objects.create(customer=user, key='pay-1', request_path=url,
+                                  expires_at=timezone.now() + timedelta(minutes=1))
+    response = client.post(url, format='json', HTTP_IDEMPOTENCY_KEY='pay-1')
+    assert response.status_code == 409
+    assert Cart.objects.get(pk=order_processed.product_list_id).status == Cart.PROCESSED
+
+
+@pytest.mark.django_db
+def test_job_detail_owner_only(api_client_auth, api_client_user, order_processed):
+    client, _ = api_client_auth
+    other_client, _ = api_client_user
+    response = client.post(reverse('order_payment_api', kwargs={'pk': order_processed.id}), format='json')
+    assert other_client.get(response['Location']).status_code == 404
+    assert client.get(response['Location']).data['status'] == Job.QUEUED
+
+
+@pytest.mark.django_db
+def test_run_workers_command(order_processed):
+    CartItem.objects.filter(cart=order_processed.product_list).update(amount=1)
+    Product.objects.update(amount_in_stock=10)
+    job = jobs.enqueue(Job.ORDER_PAYMENT, {'order': order_processed.id})
+    abandoned = jobs.enqueue(Job.ORDER_PAYMENT, {'order': order_processed.id})
+    Job.objects.filter(pk=abandoned.pk).update(status=Job.RUNNING, started_at=timezone.now() - timedelta(days=1))
+    out = StringIO()
+    call_command('run_workers', '--workers', '0', '--burst', stdout=out)
+    assert "Requeued 1 abandoned jobs" in out.getvalue()
+    assert "Processed 2 jobs" in out.getvalue()
+    job.refresh_from_db()
+    abandoned.refresh_from_db()
+    assert (job.status, abandoned.status) == (Job.DONE, Job.FAILED)
+    # the second payment of the same order is refused before it can take stock or count the sale again
+    assert abandoned.result == {'status_code': 400, 'detail': ['Order is already paid']}
+    assert DailySales.objects.get().orders == 1
+
+
+@pytest.mark.django_db
+def test_payment_updates_sales_rollups(api_client_admin, order_processed):
+    cart_id = order_processed.product_list_id
+    CartItem.objects.filter(cart_id=cart_id).update(amount=2)
+    Product.objects.update(amount_in_stock=10)
+    Order.objects.filter(pk=order_processed.pk).update(lines=Order.snapshot_lines(cart_id))
+    lines = Order.objects.get(pk=order_processed.pk).lines
+    jobs.enqueue(Job.ORDER_PAYMENT, {'order': order_processed.id})
+    jobs.work(burst=True)
+    today = timezone.localdate()
+    revenue = sum(Decimal(line['total']) for line in lines)
+    assert DailySales.objects.filter(date=today).values_list('revenue', 'units', 'orders').get() == \
+        (revenue, 2 * len(lines), 1)
+    assert DailyProductSales.objects.filter(date=today).count() == len(lines)
+    client, _ = api_client_admin
+    url = reverse('sales_report_api')
+    report = client.get(url, {'start': today, 'end': today, 'group_by': 'category'}).data
+    assert Decimal(report['totals']['revenue']) == revenue
+    assert sum(Decimal(row['revenue']) for row in report['rows']) == revenue
+    assert all(row['name'] for row in report['rows'])
+    # a rebuild from the orders lands on the same numbers
+    before = client.get(url, {'group_by': 'product'}).data
+    call_command('rebuild_sales_rollups', '--chunk-days', '1', stdout=StringIO())
+    assert client.get(url, {'group_by': 'product'}).data == before
+    assert before['rows'][0]['units'] == 2
+
+
+@pytest.mark.django_db
+def test_sales_report_validation(api_client_admin, api_client_auth):
+    client, _ = api_client_admin
+    url = reverse('sales_report_api')
+    assert client.get(url, {'start': '2024-02-01', 'end': '2024-01-01'}).status_code == 400
+    assert client.get(url, {'group_by': 'customer'}).status_code == 400
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.data['totals'] == {'revenue': '0.00', 'units': 0, 'orders': 0}
+    user_client, _ = api_client_auth
+    assert user_client.get(url).status_code == 403
+
+
+@pytest.mark.django_db
+def test_apply_retention(order_processed, user2):
+    long_ago = timezone.now() - timedelta(days=400)
+    expired = timezone.localdate() - timedelta(days=1)
+    Order.objects.filter(pk=order_processed.pk).update(order_status=Order.DELIVERED, created_date=long_ago,
+                                                       paid=True, paid_date=long_ago)
+    # the archived order's card is purged once the order is gone; the one still used by an order is not
+    PaymentDetails.objects.filter(pk=order_processed.payment_details_id).update(expiration_date=expired)
+    kept_card = PaymentDetailsFactory(customer=user2, expiration_date=expired)
+    kept = OrderFactory(customer=user2, product_list=Cart.objects.create(customer=user2, status=Cart.PROCESSED),
+                        payment_details=kept_card, order_status=Order.IN_PROCESS, created_date=long_ago)
+    abandoned = Cart.objects.create(customer=user2, updated_date=long_ago)
+    fresh = Cart.objects.create(customer=user2)
+    PaymentDetailsFactory(customer=user2, expiration_date=expired)
+    lines = Order.snapshot_lines(order_processed.product_list_id)
+    out = StringIO()
+    call_command('apply_retention', '--dry-run', stdout=out)
+    assert "Would archive 1 orders" in out.getvalue()
+    assert Order.objects.filter(pk=order_processed.pk).exists()
+    call_command('apply_retention', '--chunk-size', '1', stdout=out)
+    assert "Archived 1 orders, purged 1 abandoned carts and 2 expired payment details" in out.getvalue()
+    archived = ArchivedOrder.objects.get(order_id=order_processed.pk)
+    assert archived.lines == lines
+    assert archived.shipping_address['city'] == order_processed.shipping_address.city
+    assert not Cart.objects.filter(pk__in=[order_processed.product_list_id, abandoned.pk]).exists()
+    assert not CartItem.objects.filter(cart_id=order_processed.product_list_id).exists()
+    assert Order.objects.filter(pk=kept.pk).exists() and Cart.objects.filter(pk=fresh.pk).exists()
+    assert list(PaymentDetails.objects.filter(expiration_date=expired)) == [kept_card]
+    # archived sales still count when the rollups are rebuilt
+    call_command('rebuild_sales_rollups', stdout=StringIO())
+    assert DailySales.objects.get(date=timezone.localdate(long_ago)).orders == 1
+
+
+@pytest.mark.django_db
+def test_archived_order_detail(api_client_auth, api_client_user, order_processed):
+    Order.objects.filter(pk=order_processed.pk).update(order_status=Order.RECEIVED,
+                                                       created_date=timezone.now() - timedelta(days=400))
+    call_command('apply_retention', stdout=StringIO())
+    client, _ = api_client_auth
+    url = reverse('archived_order_detail_api', kwargs={'order_id': order_processed.pk})
+    response = client.get(url)
     assert response.status_code == 200
+    assert response.data['order_status'] == 'Received'
+    assert len(response.data['lines']) == 4
+    assert client.get(reverse('archived_order_list_api')).data['count'] == 1
+    other_client, _ = api_client_user
+    assert other_client.get(url).status_code == 404
+    assert other_client.get(reverse('archived_order_list_api')).data['count'] == 0
 
 
 @pytest.mark.django_db